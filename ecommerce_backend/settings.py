@@ -40,6 +40,16 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
+    # orjson when installed, the stdlib json otherwise
+    'DEFAULT_RENDERER_CLASSES': [
+        'main.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'main.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 SIMPLE_JWT = {
@@ -136,6 +146,52 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Point CACHE_BACKEND/CACHE_LOCATION at a shared cache (redis, memcached) when running
+# more than one process, so cache invalidations reach every worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='ecommerce-backend'),
+    },
+    # Open carts of the cache cart store. Unlike the default cache this one holds the only
+    # copy of the carts, so it has to be shared and persistent (redis without eviction).
+    # The cache store refuses to start on the local memory default, see main/checks.py.
+    'carts': {
+        'BACKEND': config('CART_CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CART_CACHE_LOCATION', default='carts'),
+    },
+}
+
+# 'database' keeps open carts as open Order rows, 'cache' in the carts cache until checkout.
+# Carts still in the database are moved to the cache the first time the cache store reads them.
+CART_STORE = config('CART_STORE', default='database')
+CART_CACHE = 'carts'
+CART_TIMEOUT = 60 * 60 * 24 * 30
+CART_LOCK_TIMEOUT = 5
+
+# Stock held by a cart is given back by release_stock_reservations after this long idle
+STOCK_RESERVATION_TIMEOUT = 60 * 30
+
+# Cached payloads are invalidated by version bumps, the timeout only bounds memory
+NAVIGATION_CACHE_TIMEOUT = 60 * 60 * 24
+FACETS_CACHE_TIMEOUT = 60 * 60 * 24
+# Decoded payloads each process keeps of the current versions, least recently used dropped first
+CACHING_MEMO_SIZE = 256
+
+# The autocomplete index lives in each process, rebuilt in the background at least this often for popularity
+SUGGEST_INDEX_MAX_AGE = 60 * 60
+
+# Popular items are refreshed this often, without invalidating the pages showing them
+POPULAR_ITEMS_MAX_AGE = 60 * 5
+
+# Cached catalog responses are invalidated by the catalog version, this bounds the staleness
+# of what changes without a signal (precomputed related products, bought together)
+RESPONSE_CACHE_TIMEOUT = 60 * 15
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -190,6 +246,22 @@ LOGIN_URL = 'login'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 TINYMCE_JS_ROOT = os.path.join(STATIC_ROOT, "tinymce")
 
+# Related products model, flagged stale when the item descriptions change and refit by
+# `manage.py build_item_similarity --if-stale` run from cron
+RECOMMENDATION_MODEL_DIR = os.path.join(BASE_DIR, 'data', 'recommendations')
+# Model versions younger than this are never pruned, they may be mapped or still being written
+RECOMMENDATION_PRUNE_GRACE = 60 * 60
+# Order co-occurrence counts kept between incremental "bought together" runs
+COOCCURRENCE_STATE_DIR = os.path.join(BASE_DIR, 'data', 'cooccurrence')
+# How far back each run rescans for orders that committed after later ones were counted
+COOCCURRENCE_OVERLAP = 60 * 60
+# Time after which a sale counts half as much towards an item's popularity
+POPULARITY_HALF_LIFE_DAYS = 7
+# Precompressed JSON snapshots of the public catalog, for nginx or a CDN to serve
+CATALOG_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'data', 'snapshots')
+# Queue a new snapshot whenever the catalog changes, built by `build_catalog_snapshot --queued --loop`
+CATALOG_SNAPSHOT_ON_CHANGE = config('CATALOG_SNAPSHOT_ON_CHANGE', default=False, cast=bool)
+
 CORS_ALLOW_ALL_ORIGINS = True
 
 CORS_ALLOWED_ORIGINS = [
@@ -203,10 +275,20 @@ CSRF_TRUSTED_ORIGINS = ['http://127.0.0.1:3000', 'http://localhost:3000']
 SITE_ID = 1
 
 # Django Email
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.gmail.com'
-EMAIL_USE_TLS = True
-EMAIL_PORT = 587
+EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.smtp.EmailBackend')
+EMAIL_HOST = config('EMAIL_HOST', default='smtp.gmail.com')
+EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=True, cast=bool)
+EMAIL_PORT = config('EMAIL_PORT', default=587, cast=int)
 EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+EMAIL_TIMEOUT = 30
+
+# Requests queue their mail in the outbox, the send_queued_mail command sends it.
+# A failed mail is retried after 1, 2, 4... minutes (at most an hour) until it
+# failed EMAIL_OUTBOX_MAX_ATTEMPTS times.
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_RETRY_DELAY = 60
+EMAIL_OUTBOX_MAX_RETRY_DELAY = 60 * 60
+# Mail claimed by a worker that died before sending it is retried after this long
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 60 * 10
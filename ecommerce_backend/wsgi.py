@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_backend.settings')
 
 application = get_wsgi_application()
+
+# build the autocomplete and fuzzy search indexes before the first request needs them
+from main import fuzzy, suggest  # noqa: E402
+
+suggest.start_rebuild()
+fuzzy.start_rebuild()
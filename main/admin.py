@@ -218,6 +218,63 @@ class OfferAdmin(admin.ModelAdmin):
     search_fields = ['title', 'offer_type']
 
 
+class ItemSimilarityAdmin(admin.ModelAdmin):
+    list_display = [
+        'item',
+        'similar_item',
+        'rank',
+        'score'
+    ]
+    search_fields = ['item__name']
+    raw_id_fields = ['item', 'similar_item']
+
+
+class ItemCooccurrenceAdmin(admin.ModelAdmin):
+    list_display = [
+        'item',
+        'related_item',
+        'rank',
+        'score',
+        'count'
+    ]
+    search_fields = ['item__name']
+    raw_id_fields = ['item', 'related_item']
+
+
+class ItemPopularityAdmin(admin.ModelAdmin):
+    list_display = [
+        'item',
+        'score',
+        'updated_at'
+    ]
+    search_fields = ['item__name']
+    raw_id_fields = ['item']
+
+
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = [
+        'user',
+        'item',
+        'quantity',
+        'expires_at'
+    ]
+    search_fields = ['user__username', 'item__name']
+    raw_id_fields = ['user', 'item']
+
+
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = [
+        'subject',
+        'recipients',
+        'status',
+        'attempts',
+        'next_attempt_at',
+        'sent_at'
+    ]
+    list_filter = ['status']
+    search_fields = ['subject']
+
+
 class WishlistAdmin(admin.ModelAdmin):
     list_display = [
         'user',
@@ -244,4 +301,9 @@ admin.site.register(Contact, ContactAdmin)
 admin.site.register(Review, ReviewAdmin)
 admin.site.register(Post, PostAdmin)
 admin.site.register(Offer, OfferAdmin)
-admin.site.register(Wishlist, WishlistAdmin)
\ No newline at end of file
+admin.site.register(Wishlist, WishlistAdmin)
+admin.site.register(ItemSimilarity, ItemSimilarityAdmin)
+admin.site.register(ItemCooccurrence, ItemCooccurrenceAdmin)
+admin.site.register(ItemPopularity, ItemPopularityAdmin)
+admin.site.register(StockReservation, StockReservationAdmin)
+admin.site.register(EmailOutbox, EmailOutboxAdmin)
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .renderers import FastJSONRenderer
+
+
+# decoded payloads of the current versions, so a hit does not even unpickle,
+# least recently used first and bounded by CACHING_MEMO_SIZE
+_current = OrderedDict()
+_current_lock = threading.Lock()
+
+
+def version_key(namespace):
+    return f'{namespace}:version'
+
+
+def get_version(namespace):
+    '''
+    Cached payloads are stored under a key holding their namespace version, so
+    invalidating them is a single increment. Versions start from the clock so a
+    version key evicted from the cache never comes back to an older value.
+    '''
+    key = version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(namespace):
+    key = version_key(namespace)
+    cache.set(modified_key(namespace), time.time(), timeout=None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = int(time.time() * 1000)
+        cache.set(key, version, timeout=None)
+        return version
+
+
+def modified_key(namespace):
+    return f'{namespace}:modified'
+
+
+def get_last_modified(namespace):
+    '''
+    Time of the last bump of namespace. Unknown times (never bumped, or evicted)
+    start now, a later Last-Modified only costs clients a full download.
+    '''
+    key = modified_key(namespace)
+    modified = cache.get(key)
+    if modified is None:
+        modified = time.time()
+        if not cache.add(key, modified, timeout=None):
+            modified = cache.get(key, modified)
+    return modified
+
+
+def get_or_build(namespace, name, builder, timeout):
+    '''
+    Returns the payload built by builder() for the current version of namespace.
+    The payload is cached as rendered JSON bytes shared by every process.
+    '''
+    version = get_version(namespace)
+    with _current_lock:
+        current = _current.get((namespace, name))
+        if current and current[0] == version:
+            _current.move_to_end((namespace, name))
+            return current[1]
+
+    key = f'{namespace}:{version}:{name}'
+    payload = cache.get(key)
+    if payload is None:
+        payload = FastJSONRenderer().render(builder())
+        cache.set(key, payload, timeout)
+    data = json.loads(payload)
+    with _current_lock:
+        _current[(namespace, name)] = (version, data)
+        _current.move_to_end((namespace, name))
+        while len(_current) > settings.CACHING_MEMO_SIZE:
+            _current.popitem(last=False)
+    return data
@@ -0,0 +1,386 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import stock
+from .models import Color, Item, Order, OrderItem, get_order_totals
+from .serializers import CartOrderSerializer, ItemSerializer, OrderSerializer
+
+
+TOTAL_FIELDS = ('subtotal', 'discount', 'total_profit_loss', 'line_count')
+
+
+class CartError(Exception):
+    pass
+
+
+def parse_operations(operations):
+    '''
+    Validates the operations of a cart sync request. Each one names an item by
+    slug and optionally a color id, and either sets the line to `quantity`
+    (0 removes it) or changes it by `add`.
+    '''
+    if not isinstance(operations, list) or not operations:
+        raise CartError('Send a non empty list of operations.')
+    parsed = []
+    for operation in operations:
+        try:
+            slug = str(operation['item'])
+            color_id = int(operation['color']) if operation.get('color') is not None else None
+            if 'quantity' in operation:
+                quantity, relative = int(operation['quantity']), False
+                if quantity < 0:
+                    raise CartError('The quantity cannot be less than zero.')
+            else:
+                quantity, relative = int(operation['add']), True
+        except (TypeError, KeyError, ValueError, AttributeError):
+            raise CartError('Each operation needs an item and a quantity or add.')
+        parsed.append((slug, color_id, quantity, relative))
+    return parsed
+
+
+def get_operation_rows(operations):
+    '''The items (by slug) and colors (by id) the operations name, one query each.'''
+    items = Item.objects.in_bulk({slug for slug, _, _, _ in operations}, field_name='slug')
+    colors = Color.objects.in_bulk({color_id for _, color_id, _, _ in operations if color_id is not None})
+    return items, colors
+
+
+def apply_operations(quantities, operations, items, colors):
+    '''
+    Applies parsed operations to `quantities`, the cart lines as a dict
+    (item_id, color_id) -> quantity. Lines falling to 0 or less stay in the dict
+    for the caller to drop. Raises CartError on the first invalid operation, the
+    stock is checked when it is reserved, see reserve_stock.
+    '''
+    for slug, color_id, quantity, relative in operations:
+        item = items.get(slug)
+        if color_id is not None and color_id not in colors:
+            raise CartError(f'The color {color_id} does not exist.')
+        key = (item.id, color_id) if item is not None else None
+        current = quantities.get(key, 0)
+        quantity = current + quantity if relative else quantity
+        # lines of items made inactive can still be lowered and removed
+        if quantity > current and (item is None or not item.is_active):
+            raise CartError(f'The item {slug} does not exist.')
+        if key is not None:
+            quantities[key] = quantity
+
+
+def reserve_stock(user, quantities):
+    '''Reserves the stock of the cart lines, colors of an item share its stock.'''
+    per_item = {}
+    for (item_id, _), quantity in quantities.items():
+        if quantity > 0:
+            per_item[item_id] = per_item.get(item_id, 0) + quantity
+    try:
+        stock.reserve(user, per_item)
+    except stock.OutOfStock as e:
+        raise CartError(str(e))
+
+
+def get_line_totals(lines):
+    '''The running totals of Order.recalculate_totals, computed from lines in memory.'''
+    subtotal = sum(line.get_final_price() for line in lines)
+    return {
+        'subtotal': round(subtotal, 2),
+        'discount': round(sum(line.get_total_item_price() for line in lines) - subtotal, 2),
+        'total_profit_loss': sum(line.profit_loss for line in lines),
+        'line_count': len(lines),
+    }
+
+
+def get_cart_context(order, lines=None):
+    if lines is not None:
+        # lines that are not rows yet, see CacheCartStore
+        data = CartOrderSerializer(order, context={'lines': lines}).data
+    else:
+        data = OrderSerializer(order).data
+    return {
+        'order': data,
+        'subtotal': order.get_subtotal() if order else 0,
+        'total': order.get_total() if order else 0,
+    }
+
+
+class DatabaseCartStore:
+    '''The open cart of a user is their Order with ordered=False and its OrderItem lines.'''
+
+    def get_quantities(self, user):
+        quantities = {}
+        lines = OrderItem.objects.filter(order__user=user, order__ordered=False).values_list('item_id', 'color_id', 'quantity')
+        for item_id, color_id, quantity in lines:
+            quantities[(item_id, color_id)] = quantities.get((item_id, color_id), 0) + quantity
+        return quantities
+
+    def apply(self, user, operations):
+        '''
+        Applies every operation to the user's open order in one transaction: one
+        query per kind of row read (order, items, colors, lines) and bulk writes,
+        however many operations there are. Nothing is written if one of them is invalid.
+        '''
+        operations = parse_operations(operations)
+        with transaction.atomic():
+            # lock the open order so concurrent syncs of the same cart apply one after the other
+            order = Order.objects.select_for_update().filter(user=user, ordered=False).first()
+            if order is None:
+                order = Order.objects.create(user=user, ordered_date=timezone.now())
+            items, colors = get_operation_rows(operations)
+
+            lines, removed = {}, []
+            for line in order.items.select_related('item').order_by('id'):
+                key = (line.item_id, line.color_id)
+                if key in lines:
+                    # merge the duplicate lines older versions of add_to_cart created
+                    lines[key].quantity += line.quantity
+                    removed.append(line)
+                else:
+                    lines[key] = line
+
+            quantities = {key: line.quantity for key, line in lines.items()}
+            apply_operations(quantities, operations, items, colors)
+            reserve_stock(user, quantities)
+
+            updated, created = [], []
+            items_by_id = {item.id: item for item in items.values()}
+            for key, quantity in quantities.items():
+                line = lines.get(key)
+                if quantity <= 0:
+                    if line is not None:
+                        removed.append(line)
+                    continue
+                if line is None:
+                    line = OrderItem(user=user, item=items_by_id[key[0]], color=colors.get(key[1]))
+                    created.append(line)
+                else:
+                    updated.append(line)
+                line.quantity = quantity
+                line.compute_prices()
+
+            if removed:
+                order.items.remove(*removed)
+                OrderItem.objects.filter(pk__in=[line.pk for line in removed]).delete()
+            if updated:
+                OrderItem.objects.bulk_update(updated, ['quantity', 'selling_price', 'profit_loss'])
+            if created:
+                OrderItem.objects.bulk_create(created)
+                order.items.add(*created)
+            order.recalculate_totals()
+
+    def get_context(self, user):
+        order = OrderSerializer.setup_eager_loading(Order.objects.filter(user=user, ordered=False)).first()
+        return get_cart_context(order)
+
+    def checkout(self, user):
+        '''
+        Locks and returns the open order with its totals at the current prices,
+        the caller marks it ordered in the same transaction. Stock of lines whose
+        reservation expired is taken again, or CartError is raised.
+        '''
+        order = Order.objects.select_for_update().get(user=user, ordered=False)
+        reserve_stock(user, self.get_quantities(user))
+        stock.consume(user)
+        order.recalculate_totals()
+        return order
+
+
+class CacheCartStore:
+    '''
+    The open cart of a user is a list of [item_id, color_id, quantity] in the
+    `carts` cache, so filling a cart writes no rows. It becomes an Order with its
+    OrderItem lines when the checkout commits.
+    '''
+
+    def get_cache(self):
+        return caches[settings.CART_CACHE]
+
+    def get_key(self, user):
+        return f'cart:{user.pk}'
+
+    def load(self, user):
+        '''
+        Returns the (token, quantities) of the cart. The token names this cart until
+        it is ordered, see checkout. A user without a cart in the cache gets the open
+        Order the database store left, once.
+        '''
+        cache, key = self.get_cache(), self.get_key(user)
+        entry = cache.get(key)
+        if entry is None:
+            orders = list(Order.objects.filter(user=user, ordered=False).values_list('pk', flat=True))
+            quantities = DatabaseCartStore().get_quantities(user) if orders else {}
+            entry = {'token': uuid.uuid4().hex, 'lines': [[item_id, color_id, quantity] for (item_id, color_id), quantity in quantities.items()]}
+            if cache.add(key, entry, settings.CART_TIMEOUT):
+                if orders:
+                    with transaction.atomic():
+                        OrderItem.objects.filter(order__in=orders).delete()
+                        Order.objects.filter(pk__in=orders).delete()
+            else:
+                # a concurrent request stored the cart meanwhile
+                entry = cache.get(key) or entry
+        return entry['token'], {(item_id, color_id): quantity for item_id, color_id, quantity in entry['lines']}
+
+    def get_quantities(self, user):
+        return self.load(user)[1]
+
+    def store(self, user, token, quantities):
+        lines = [[item_id, color_id, quantity] for (item_id, color_id), quantity in quantities.items() if quantity > 0]
+        self.get_cache().set(self.get_key(user), {'token': token, 'lines': lines}, settings.CART_TIMEOUT)
+
+    def clear(self, user):
+        self.get_cache().delete(self.get_key(user))
+
+    def acquire(self, user):
+        '''Takes the lock of the cart, see lock, and returns the token to release it with.'''
+        cache, key, token = self.get_cache(), self.get_key(user) + ':lock', uuid.uuid4().hex
+        deadline = time.monotonic() + settings.CART_LOCK_TIMEOUT
+        while not cache.add(key, token, settings.CART_LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                raise CartError('Your cart is being updated, please try again.')
+            time.sleep(0.01)
+        return token
+
+    def release(self, user, token):
+        cache, key = self.get_cache(), self.get_key(user) + ':lock'
+        if cache.get(key) == token:
+            cache.delete(key)
+
+    @contextmanager
+    def lock(self, user):
+        '''Serializes the read-modify-write of one cart across processes sharing the cache.'''
+        token = self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release(user, token)
+
+    def get_lines(self, user, items=None, quantities=None):
+        '''Unsaved OrderItem lines priced at the current item prices, `items` is the queryset to load them from.'''
+        if quantities is None:
+            quantities = self.get_quantities(user)
+        if not quantities:
+            return []
+        items = (Item.objects if items is None else items).in_bulk({item_id for item_id, _ in quantities})
+        colors = Color.objects.in_bulk({color_id for _, color_id in quantities if color_id is not None})
+        lines = []
+        for (item_id, color_id), quantity in quantities.items():
+            item = items.get(item_id)
+            if item is None:
+                # deleted since it was added
+                continue
+            line = OrderItem(user=user, item=item, color=colors.get(color_id), quantity=quantity)
+            line.compute_prices()
+            lines.append(line)
+        return lines
+
+    def apply(self, user, operations):
+        operations = parse_operations(operations)
+        items, colors = get_operation_rows(operations)
+        with self.lock(user):
+            token, quantities = self.load(user)
+            apply_operations(quantities, operations, items, colors)
+            reserve_stock(user, quantities)
+            self.store(user, token, quantities)
+
+    def get_context(self, user):
+        lines = self.get_lines(user, ItemSerializer.setup_eager_loading(Item.objects.all()))
+        if not lines:
+            return get_cart_context(None)
+        order = Order(user=user)
+        for name, value in get_line_totals(lines).items():
+            setattr(order, name, value)
+        return get_cart_context(order, lines)
+
+    def checkout(self, user):
+        '''
+        Writes the cart as an open Order and returns it, the caller marks it ordered
+        in the same transaction. Stock of lines whose reservation expired is taken
+        again, or CartError is raised. The cart is dropped from the cache once that commits.
+        The order carries the cart token under a unique constraint: a second checkout
+        of the same cart in another worker waits on the first one's insert and fails
+        once it committed, before touching the stock.
+        '''
+        lock = self.acquire(user)
+        try:
+            token, quantities = self.load(user)
+            lines = self.get_lines(user, quantities=quantities)
+            if not lines:
+                raise Order.DoesNotExist('The cart is empty.')
+            for line in lines:
+                if not line.item.is_active:
+                    raise CartError(f'{line.item.name} is no longer available.')
+            try:
+                with transaction.atomic():
+                    order = Order.objects.create(user=user, ordered_date=timezone.now(), cart_token=token)
+            except IntegrityError:
+                self.clear(user)
+                raise CartError('This cart was already ordered.')
+            reserve_stock(user, {(line.item_id, line.color_id): line.quantity for line in lines})
+            stock.consume(user)
+            OrderItem.objects.bulk_create(lines)
+            order.items.add(*lines)
+            order.recalculate_totals()
+        except BaseException:
+            self.release(user, lock)
+            raise
+
+        def ordered():
+            self.clear(user)
+            self.release(user, lock)
+
+        # the lock is held until the order commits, a sync in between would be
+        # dropped with the cart and leave its reservations behind. If the caller
+        # rolls back, the lock expires after CART_LOCK_TIMEOUT.
+        transaction.on_commit(ordered)
+        return order
+
+
+STORES = {
+    'database': DatabaseCartStore(),
+    'cache': CacheCartStore(),
+}
+
+
+def get_cart_store():
+    return STORES[settings.CART_STORE]
+
+
+def sync_cart(user, operations):
+    '''Applies the operations to the user's cart, all of them or none.'''
+    get_cart_store().apply(user, operations)
+
+
+def reconcile_totals(batch_size=1000):
+    '''
+    Recomputes the running totals of every open order with one grouped aggregate
+    query and writes back the ones that drifted, e.g. after item prices changed.
+    Placed orders keep the totals they were charged. Returns (checked, fixed).
+    '''
+    aggregates = {f'new_{name}': value for name, value in get_order_totals('items__').items()}
+    orders = Order.objects.filter(ordered=False).annotate(**aggregates).only('id', *TOTAL_FIELDS).order_by('id')
+    checked, fixed, batch = 0, 0, []
+    for order in orders.iterator(chunk_size=batch_size):
+        checked += 1
+        totals = {
+            'subtotal': round(order.new_subtotal, 2),
+            'discount': round(order.new_discount, 2),
+            'total_profit_loss': order.new_total_profit_loss,
+            'line_count': order.new_line_count,
+        }
+        if all(round(getattr(order, name), 2) == round(value, 2) for name, value in totals.items()):
+            continue
+        for name, value in totals.items():
+            setattr(order, name, value)
+        batch.append(order)
+        if len(batch) >= batch_size:
+            Order.objects.bulk_update(batch, TOTAL_FIELDS)
+            fixed += len(batch)
+            batch = []
+    if batch:
+        Order.objects.bulk_update(batch, TOTAL_FIELDS)
+        fixed += len(batch)
+    return checked, fixed
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+# backends that keep entries per process or not at all
+UNSHARED_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def check_cart_cache(app_configs, **kwargs):
+    '''The cache cart store keeps the only copy of open carts, it needs a shared cache.'''
+    if settings.CART_STORE != 'cache':
+        return []
+    backend = settings.CACHES.get(settings.CART_CACHE, {}).get('BACKEND')
+    if backend in UNSHARED_CACHE_BACKENDS:
+        return [Error(
+            f'CART_STORE is \'cache\' but the {settings.CART_CACHE!r} cache uses {backend}.',
+            hint='Point CART_CACHE_BACKEND at a shared, persistent cache such as redis, or set CART_STORE to \'database\'.',
+            id='main.E001',
+        )]
+    return []
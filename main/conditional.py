@@ -0,0 +1,48 @@
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from .caching import get_last_modified, get_version
+
+
+CATALOG = 'catalog'
+
+
+def wishlist_namespace(user_id):
+    return f'wishlist:{user_id}'
+
+
+def get_period(refresh_every):
+    return int(time.time() // refresh_every) if refresh_every else 0
+
+
+def catalog_validators(personal=False, refresh_every=None):
+    '''
+    Returns the (etag_func, last_modified_func) pair for django's condition()
+    decorator. Both only read version counters from the cache, so a request
+    answered with 304 runs no query and serializes nothing.
+
+    personal: the payload holds the user's wishlist flags.
+    refresh_every: the payload also holds data refreshed every that many seconds
+    without a version bump (popular items), it is treated as changed that often.
+    '''
+
+    def get_namespaces(request):
+        namespaces = [CATALOG]
+        if personal and request.user.is_authenticated:
+            namespaces.append(wishlist_namespace(request.user.id))
+        return namespaces
+
+    def etag_func(request, *args, **kwargs):
+        user_id = request.user.id if personal else None
+        versions = [get_version(namespace) for namespace in get_namespaces(request)]
+        # hashed so the tag does not expose the user id
+        return hashlib.md5(repr((user_id, versions, get_period(refresh_every))).encode()).hexdigest()
+
+    def last_modified_func(request, *args, **kwargs):
+        modified = max(get_last_modified(namespace) for namespace in get_namespaces(request))
+        if refresh_every:
+            modified = max(modified, get_period(refresh_every) * refresh_every)
+        return datetime.fromtimestamp(modified, tz=timezone.utc)
+
+    return etag_func, last_modified_func
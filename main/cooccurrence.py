@@ -0,0 +1,196 @@
+import json
+import os
+from datetime import timedelta
+
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from .models import Item, Order, ItemCooccurrence
+
+
+METRICS = ('jaccard', 'lift')
+STATE_FILE = 'state.npz'
+
+
+def get_state_dir():
+    return settings.COOCCURRENCE_STATE_DIR
+
+
+def empty_state():
+    return sp.csr_matrix((0, 0), dtype=np.int64), {'baskets': 0, 'last_ordered_date': None, 'recent_orders': [], 'metric': None}
+
+
+def load_state():
+    '''
+    The raw counts are kept between runs so an incremental run only has to scan
+    the orders placed since the last one. counts[i, j] is the number of baskets
+    holding both item i and item j; the diagonal holds the baskets per item.
+    recent_orders are the [id, ordered_date] of the orders counted within
+    COOCCURRENCE_OVERLAP of the watermark, see count_baskets.
+    '''
+    try:
+        with np.load(os.path.join(get_state_dir(), STATE_FILE)) as stored:
+            counts = sp.csr_matrix((stored['data'], stored['indices'], stored['indptr']), shape=tuple(stored['shape']))
+            state = json.loads(str(stored['state']))
+    except FileNotFoundError:
+        return empty_state()
+    return counts, state
+
+
+def save_state(counts, state):
+    state_dir = get_state_dir()
+    os.makedirs(state_dir, exist_ok=True)
+    # counts and watermark live in one file replaced atomically, so a crash can
+    # never pair new counts with an old watermark and count orders twice
+    tmp_file = os.path.join(state_dir, 'tmp_' + STATE_FILE)
+    with open(tmp_file, 'wb') as f:
+        np.savez(
+            f,
+            data=counts.data, indices=counts.indices, indptr=counts.indptr,
+            shape=np.array(counts.shape), state=np.array(json.dumps(state)),
+        )
+    os.replace(tmp_file, os.path.join(state_dir, STATE_FILE))
+
+
+def resize(matrix, size):
+    if matrix.shape[0] >= size:
+        return matrix
+    matrix = matrix.tocoo()
+    return sp.csr_matrix((matrix.data, (matrix.row, matrix.col)), shape=(size, size), dtype=np.int64)
+
+
+def count_baskets(since=None, counted=()):
+    '''
+    Returns the item x item co-occurrence counts of the orders placed after `since`
+    and not in `counted`, the number of baskets scanned and their ordered dates by id.
+    An order's ordered_date is set before its transaction commits, so an order can
+    become visible after later ones were counted: the scan reaches back
+    COOCCURRENCE_OVERLAP before `since` and skips the orders already counted.
+    '''
+    lines = Order.items.through.objects.filter(order__ordered=True)
+    if since is not None:
+        lines = lines.filter(order__ordered_date__gt=since - timedelta(seconds=settings.COOCCURRENCE_OVERLAP))
+    lines = lines.values_list('order_id', 'orderitem__item_id', 'order__ordered_date')
+
+    counted = set(counted)
+    order_ids, item_ids, ordered_dates = [], [], {}
+    for order_id, item_id, ordered_date in lines.iterator(chunk_size=10000):
+        if order_id in counted:
+            continue
+        order_ids.append(order_id)
+        item_ids.append(item_id)
+        ordered_dates[order_id] = ordered_date
+    if not order_ids:
+        return sp.csr_matrix((0, 0), dtype=np.int64), 0, {}
+
+    baskets, rows = np.unique(np.array(order_ids, dtype=np.int64), return_inverse=True)
+    columns = np.array(item_ids, dtype=np.int64)
+    size = int(columns.max()) + 1
+    # basket x item incidence matrix, the same item twice in a basket (two colors) counts once
+    incidence = sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, columns)), shape=(len(baskets), size))
+    incidence.data[:] = 1
+    counts = (incidence.T @ incidence).tocsr()
+    return counts, len(baskets), ordered_dates
+
+
+def score(counts, baskets, metric):
+    '''Normalised pair scores as a CSR matrix with the same sparsity as the off diagonal counts.'''
+    counts = counts.tocoo()
+    support = counts.diagonal().astype(np.float64)
+    keep = counts.row != counts.col
+    rows, columns, together = counts.row[keep], counts.col[keep], counts.data[keep].astype(np.float64)
+    if metric == 'lift':
+        values = together * baskets / (support[rows] * support[columns])
+    else:
+        values = together / (support[rows] + support[columns] - together)
+    return sp.csr_matrix((values, (rows, columns)), shape=counts.shape)
+
+
+def get_active(size):
+    '''
+    Marks the ids of the active items. The stored counts still hold the items
+    deleted or deactivated since they were counted, these must not be written.
+    '''
+    active = np.zeros(size, dtype=bool)
+    active[list(Item.objects.filter(is_active=True, id__lt=size).values_list('id', flat=True))] = True
+    return active
+
+
+def top_related(scores, counts, active, item_id, top_n, min_count):
+    start, end = scores.indptr[item_id], scores.indptr[item_id + 1]
+    columns, values = scores.indices[start:end], scores.data[start:end]
+    together = np.asarray(counts[item_id, columns].todense()).ravel() if len(columns) else np.zeros(0)
+    keep = (together >= min_count) & active[columns]
+    columns, values, together = columns[keep], values[keep], together[keep]
+    if len(values) > top_n:
+        top = np.argpartition(-values, top_n - 1)[:top_n]
+        columns, values, together = columns[top], values[top], together[top]
+    order = np.lexsort((columns, -values))
+    return [(int(columns[i]), float(values[i]), int(together[i])) for i in order]
+
+
+def update(full=False, metric='jaccard', top_n=10, min_count=1, batch_size=500):
+    if full:
+        counts, state = empty_state()
+    else:
+        counts, state = load_state()
+    since = parse_datetime(state['last_ordered_date']) if state['last_ordered_date'] else None
+    recent = {order_id: parse_datetime(ordered_date) for order_id, ordered_date in state.get('recent_orders', [])}
+
+    delta, baskets, ordered_dates = count_baskets(since, recent)
+    size = max(counts.shape[0], delta.shape[0])
+    counts = resize(counts, size) + resize(delta, size)
+    state['baskets'] += baskets
+    recent.update(ordered_dates)
+    if recent:
+        since = max(filter(None, [since, *recent.values()]))
+        state['last_ordered_date'] = since.isoformat()
+        window_start = since - timedelta(seconds=settings.COOCCURRENCE_OVERLAP)
+        state['recent_orders'] = [
+            [order_id, ordered_date.isoformat()] for order_id, ordered_date in recent.items() if ordered_date > window_start
+        ]
+
+    if full or state['metric'] != metric or (metric == 'lift' and baskets):
+        # every stored row was computed with another metric, or the basket count
+        # every lift is scaled by changed: rewrite them all
+        affected = np.flatnonzero(counts.diagonal())
+    else:
+        # a pair score depends on both items' support, so the neighbours of every item
+        # in the new baskets have to be rescored along with the items themselves
+        changed = np.flatnonzero(delta.diagonal())
+        affected = np.union1d(changed, counts[changed].indices) if len(changed) else changed
+    state['metric'] = metric
+    active = get_active(size)
+    affected = affected[active[affected]]
+
+    scores = score(counts, state['baskets'], metric)
+    batch = {}
+    for item_id in affected:
+        batch[int(item_id)] = top_related(scores, counts, active, int(item_id), top_n, min_count)
+        if len(batch) >= batch_size:
+            write(batch)
+            batch = {}
+    if batch:
+        write(batch)
+    if full:
+        stored = np.array(ItemCooccurrence.objects.order_by().values_list('item_id', flat=True).distinct(), dtype=np.int64)
+        stale = np.setdiff1d(stored, affected)
+        for start in range(0, len(stale), batch_size):
+            ItemCooccurrence.objects.filter(item_id__in=stale[start:start + batch_size].tolist()).delete()
+
+    save_state(counts, state)
+    return baskets, len(affected)
+
+
+def write(batch):
+    rows = [
+        ItemCooccurrence(item_id=item_id, related_item_id=related_item_id, score=value, count=together, rank=rank)
+        for item_id, related in batch.items()
+        for rank, (related_item_id, value, together) in enumerate(related)
+    ]
+    with transaction.atomic():
+        ItemCooccurrence.objects.filter(item_id__in=list(batch)).delete()
+        ItemCooccurrence.objects.bulk_create(rows, batch_size=1000)
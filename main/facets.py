@@ -0,0 +1,94 @@
+from django.conf import settings
+from django.db.models import Count, Max, Min
+
+from .caching import get_or_build
+from .models import Brand, Color, Item
+from .serializers import BrandSerializer, ColorSerializer
+
+
+FACETS = 'facets'
+
+# filter name -> the item field its values (slugs) are matched against
+FACET_FIELDS = {
+    'categories': 'category__slug',
+    'subcategories': 'subcategory__slug',
+    'brands': 'brand__slug',
+}
+
+
+def unique_by(rows, field):
+    seen = set()
+    unique = []
+    for row in rows:
+        value = getattr(row, field)
+        if value not in seen:
+            seen.add(value)
+            unique.append(row)
+    return unique
+
+
+def build_facet_summary(items=None):
+    '''
+    Price range plus the brands and colors (one per name / color code) of `items`,
+    or of the whole catalog. One aggregate scan for both price bounds, and the
+    de-duplication happens here so it does not rely on Postgres' DISTINCT ON.
+    '''
+    if items is None:
+        price_range = Item.objects.aggregate(Min('price'), Max('price'))
+        brands = Brand.objects.all()
+        colors = Color.objects.all()
+    else:
+        price_range = items.aggregate(Min('price'), Max('price'))
+        brands = Brand.objects.filter(pk__in=items.values('brand_id'))
+        colors = Color.objects.filter(pk__in=Item.color.through.objects.filter(item__in=items).values('color_id'))
+
+    return {
+        'price_range': {
+            'min': {'price__min': price_range['price__min']},
+            'max': {'price__max': price_range['price__max']},
+        },
+        'brands': BrandSerializer(unique_by(brands.order_by('name', 'id'), 'name'), many=True).data,
+        'colors': ColorSerializer(unique_by(colors.order_by('color_code', 'id'), 'color_code'), many=True).data,
+    }
+
+
+def get_facet_summary(items=None, scope='all'):
+    '''Cached facet summary, `scope` names the subset of the catalog `items` covers.'''
+    return get_or_build(FACETS, scope, lambda: build_facet_summary(items), settings.FACETS_CACHE_TIMEOUT)
+
+
+def filter_items(items, filters, exclude=None):
+    '''Applies every facet filter in `filters` to `items`, except the `exclude` one.'''
+    for facet, field in FACET_FIELDS.items():
+        values = filters.get(facet)
+        if values and facet != exclude:
+            items = items.filter(**{field + '__in': set(values)})
+    colors = filters.get('colors')
+    if colors and exclude != 'colors':
+        # a subquery instead of a join, so an item in several matching colors is returned once
+        colored = Item.color.through.objects.filter(color__color_code__in=set(colors)).values('item_id')
+        items = items.filter(pk__in=colored)
+    price_range = filters.get('price_range')
+    if price_range and exclude != 'price_range':
+        items = items.filter(price__range=price_range)
+    return items
+
+
+def count_facets(items, filters):
+    '''
+    Number of items each facet value would leave if it were selected. A facet's own
+    selection is left out of its counts (selecting a second brand widens the result),
+    the selections of all the other facets are applied. One grouped query per facet.
+    '''
+    counts = {}
+    for facet, field in FACET_FIELDS.items():
+        rows = filter_items(items, filters, exclude=facet).order_by().values(field).annotate(count=Count('pk'))
+        counts[facet] = {row[field]: row['count'] for row in rows if row[field] is not None}
+
+    colored = Item.color.through.objects.filter(item__in=filter_items(items, filters, exclude='colors'))
+    rows = colored.order_by().values('color__color_code').annotate(count=Count('item_id', distinct=True))
+    counts['colors'] = {row['color__color_code']: row['count'] for row in rows}
+
+    price_range = filter_items(items, filters, exclude='price_range').aggregate(Min('price'), Max('price'))
+    counts['price_range'] = {'min': price_range['price__min'], 'max': price_range['price__max']}
+    return counts
@@ -0,0 +1,178 @@
+import heapq
+import logging
+import math
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from django.db import connection, transaction
+
+from .caching import get_version
+from .models import Item
+from .suggest import normalize
+
+
+FUZZY = 'fuzzy'
+# share of the query trigrams a name has to contain to be returned
+THRESHOLD = 0.4
+# trigrams found in more than this share of the names ("ing", " th") are too common
+# to find candidates with, they only count when scoring the candidates
+COMMON_TRIGRAM_SHARE = 0.05
+MAX_CANDIDATES = 500
+
+logger = logging.getLogger(__name__)
+
+# held while a rebuild runs
+_lock = threading.Lock()
+_index = None
+
+
+def trigrams(text):
+    '''Trigrams of each word padded like pg_trgm does, so word starts weigh more.'''
+    found = set()
+    for word in normalize(text).split():
+        word = f'  {word} '
+        for start in range(len(word) - 2):
+            found.add(word[start:start + 3])
+    return found
+
+
+class TrigramIndex:
+    '''
+    Inverted index trigram -> sorted array of item numbers over the item and brand
+    names. Candidates come from the postings of the rarer query trigrams only, so
+    a lookup never walks the long postings of trigrams most names contain, unless
+    the query has no rare trigram at all.
+    '''
+
+    def __init__(self, documents, version):
+        self.version = version
+        self.item_ids = array('q')
+        self.sizes = array('H')
+        postings = {}
+        for number, (item_id, text) in enumerate(documents):
+            grams = trigrams(text)
+            self.item_ids.append(item_id)
+            self.sizes.append(min(len(grams), 65535))
+            for gram in grams:
+                postings.setdefault(gram, array('i')).append(number)
+        self.postings = postings
+        self.common_size = max(100, int(len(self.item_ids) * COMMON_TRIGRAM_SHARE))
+
+    def search(self, text, limit):
+        grams = trigrams(text)
+        if not grams:
+            return []
+        rare, common = [], []
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is not None:
+                (common if len(posting) > self.common_size else rare).append(posting)
+        if not rare:
+            # a returned name holds THRESHOLD of the query trigrams, so it is in one of
+            # the `split` shortest postings
+            split = len(common) - math.ceil(THRESHOLD * len(grams)) + 1
+            if split <= 0:
+                return []
+            common.sort(key=len)
+            rare, common = common[:split], common[split:]
+
+        counts = Counter()
+        for posting in rare:
+            counts.update(posting)
+        # the cap keeps the shorter names when the counts tie
+        candidates = heapq.nlargest(MAX_CANDIDATES, counts, key=lambda number: (counts[number], -self.sizes[number]))
+
+        scored = []
+        for number in candidates:
+            matched = counts[number]
+            for posting in common:
+                position = bisect_left(posting, number)
+                if position < len(posting) and posting[position] == number:
+                    matched += 1
+            score = matched / len(grams)
+            if score >= THRESHOLD:
+                # between equal scores the shorter name is the closer one
+                scored.append((score, -self.sizes[number], number))
+        best = heapq.nlargest(limit, scored)
+        return [(score, int(self.item_ids[number])) for score, _, number in best]
+
+
+def get_documents():
+    items = Item.objects.filter(is_active=True).order_by('id').values_list('id', 'name', 'brand__name')
+    for item_id, name, brand in items.iterator(chunk_size=2000):
+        yield item_id, f'{name} {brand or ""}'
+
+
+def rebuild():
+    '''Builds the index from the database and makes it the one this process answers from.'''
+    global _index
+    # read before the documents, a bump during the build leaves the new index stale
+    version = get_version(FUZZY)
+    _index = TrigramIndex(get_documents(), version)
+    return _index
+
+
+def start_rebuild():
+    '''
+    Rebuilds the index in a background thread unless one already is, returns
+    whether it started one. Called at startup from the WSGI and ASGI modules,
+    Postgres searches its own trigram indexes and needs none.
+    '''
+    if connection.vendor == 'postgresql' or not _lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            rebuild()
+        except Exception:
+            logger.exception('Could not build the fuzzy search index.')
+        finally:
+            connection.close()
+            _lock.release()
+
+    threading.Thread(target=run, name='fuzzy-index', daemon=True).start()
+    return True
+
+
+def get_index():
+    '''
+    The index of this process, rebuilt in the background when the catalog version
+    was bumped. Requests keep the previous index meanwhile and get None only
+    before the first build finished.
+    '''
+    index = _index
+    if index is None or index.version != get_version(FUZZY):
+        start_rebuild()
+    return index
+
+
+POSTGRES_SQL = '''
+    SELECT item_id, max(score) AS score FROM (
+        SELECT i.id AS item_id, word_similarity(%s, i.name) AS score
+        FROM main_item i WHERE %s <%% i.name AND i.is_active
+        UNION ALL
+        SELECT i.id, word_similarity(%s, b.name)
+        FROM main_brand b JOIN main_item i ON i.brand_id = b.id WHERE %s <%% b.name AND i.is_active
+    ) matches
+    GROUP BY item_id ORDER BY score DESC, item_id LIMIT %s
+'''
+
+
+def postgres_search(text, limit):
+    # the <% operator uses the trigram indexes, with this threshold for this transaction only
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", [str(THRESHOLD)])
+        cursor.execute(POSTGRES_SQL, [text, text, text, text, limit])
+        return [(score, item_id) for item_id, score in cursor.fetchall()]
+
+
+def fuzzy_search(text, limit=10):
+    '''Returns up to `limit` (score, item_id) of the items whose name or brand is close to `text`.'''
+    if not normalize(text):
+        return []
+    if connection.vendor == 'postgresql':
+        return postgres_search(text, limit)
+    index = get_index()
+    return index.search(text, limit) if index is not None else []
@@ -0,0 +1,97 @@
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import BadHeaderError, EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import EmailOutbox
+
+
+PENDING, SENT, FAILED = 0, 1, 2
+
+
+def queue_mail(subject, message, from_email, recipient_list):
+    '''
+    Takes the arguments of send_mail and queues the mail instead of sending it,
+    so it is only sent if the caller's transaction commits and the request does
+    not wait on SMTP. Raises BadHeaderError right away like send_mail would.
+    '''
+    if '\n' in subject or '\r' in subject:
+        raise BadHeaderError(f'Header values can\'t contain newlines (got {subject!r} for header \'Subject\')')
+    return EmailOutbox.objects.create(
+        subject=subject,
+        body=message,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        recipients=list(recipient_list),
+        next_attempt_at=timezone.now(),
+    )
+
+
+def get_retry_delay(attempts):
+    '''Exponential backoff with jitter, so mail failing together is not retried together.'''
+    delay = min(settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.EMAIL_OUTBOX_MAX_RETRY_DELAY)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def claim(batch_size):
+    '''
+    Takes the next due mail. Claimed mail is pushed back by EMAIL_OUTBOX_CLAIM_TIMEOUT,
+    so concurrent workers skip it and it is retried if this worker dies while sending.
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        mails = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status=PENDING, next_attempt_at__lte=now).order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if mails:
+            claimed_until = now + timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+            EmailOutbox.objects.filter(pk__in=[mail.pk for mail in mails]).update(next_attempt_at=claimed_until)
+    return mails
+
+
+def send_batch(batch_size=50):
+    '''Sends up to `batch_size` due mails over one connection, returns (sent, failed).'''
+    mails = claim(batch_size)
+    if not mails:
+        return 0, 0
+    sent = failed = 0
+    connection = get_connection(fail_silently=False)
+    try:
+        for mail in mails:
+            message = EmailMessage(mail.subject, mail.body, mail.from_email, mail.recipients, connection=connection)
+            mail.attempts += 1
+            try:
+                # a connection the backend did not open itself stays open between mails,
+                # open() does nothing while it is
+                connection.open()
+                message.send()
+            except Exception as e:
+                failed += 1
+                mail.last_error = repr(e)
+                if mail.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+                    mail.status = FAILED
+                else:
+                    mail.next_attempt_at = timezone.now() + get_retry_delay(mail.attempts)
+                # the connection may be broken, the next mail opens a new one
+                connection.close()
+            else:
+                sent += 1
+                mail.status = SENT
+                mail.sent_at = timezone.now()
+    finally:
+        connection.close()
+        EmailOutbox.objects.bulk_update(mails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    return sent, failed
+
+
+def send_queued(batch_size=50):
+    '''Sends the mail that is due batch after batch until none is left, returns (sent, failed).'''
+    sent = failed = 0
+    while True:
+        batch_sent, batch_failed = send_batch(batch_size)
+        if not batch_sent and not batch_failed:
+            return sent, failed
+        sent, failed = sent + batch_sent, failed + batch_failed
@@ -0,0 +1,44 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from main import renderers
+from main.models import Item
+from main.serializers import ItemSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compare the JSON renderers on ItemSerializer output.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100, help='Number of items in the payload.')
+        parser.add_argument('--repeat', type=int, default=50, help='Renders per renderer.')
+
+    def handle(self, *args, **options):
+        items = list(Item.objects.order_by('id')[:options['items']])
+        if not items:
+            self.stdout.write(self.style.WARNING('No items to serialize.'))
+            return
+        data = {'items': ItemSerializer(items, many=True).data}
+        if renderers.orjson is None:
+            self.stdout.write(self.style.WARNING('orjson is not installed, FastJSONRenderer falls back to the stdlib.'))
+
+        outputs = {}
+        for renderer in (JSONRenderer(), renderers.FastJSONRenderer()):
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                output = renderer.render(data)
+                timings.append((time.perf_counter() - start) * 1000)
+            outputs[type(renderer).__name__] = output
+            self.stdout.write(
+                f'{type(renderer).__name__:>17}: median {statistics.median(timings):.3f} ms, '
+                f'min {min(timings):.3f} ms, {len(output)} bytes for {len(items)} items'
+            )
+
+        decoded = [json.loads(output) for output in outputs.values()]
+        if decoded[0] != decoded[1]:
+            self.stdout.write(self.style.ERROR('The renderers produced different documents.'))
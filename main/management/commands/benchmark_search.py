@@ -0,0 +1,51 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import search
+from main.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Compare the full text index with the LIKE search it replaced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', help='Search texts, sampled from the item names if omitted.')
+        parser.add_argument('--samples', type=int, default=20, help='Number of queries to sample.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per query.')
+        parser.add_argument('--limit', type=int, default=24, help='Results fetched per query, one page.')
+
+    def handle(self, *args, **options):
+        queries = options['queries'] or self.sample_queries(options['samples'])
+        if not queries:
+            self.stdout.write(self.style.WARNING('No items to sample queries from.'))
+            return
+        limit = options['limit']
+
+        def like(text):
+            return list(Item.objects.filter(name__icontains=text, is_active=True).order_by('-id').values_list('id', flat=True)[:limit])
+
+        def indexed(text):
+            return search.search_items(text, limit)
+
+        for name, run in (('LIKE', like), ('index', indexed)):
+            timings, hits = [], 0
+            for text in queries:
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    results = run(text)
+                    timings.append((time.perf_counter() - start) * 1000)
+                hits += len(results)
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(
+                f'{name:>6}: median {statistics.median(timings):.2f} ms, p95 {p95:.2f} ms, '
+                f'{hits / len(queries):.1f} results per query'
+            )
+
+    def sample_queries(self, samples):
+        names = list(Item.objects.filter(is_active=True).order_by('?').values_list('name', flat=True)[:samples])
+        words = [random.choice(search.tokenize(name)) for name in names if search.tokenize(name)]
+        return words
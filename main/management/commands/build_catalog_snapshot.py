@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import snapshots
+
+
+class Command(BaseCommand):
+    help = 'Render the public catalog to precompressed static JSON files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--item', type=int, action='append', dest='item_ids',
+            help='Only render the product pages of this item (and of the items listing it), repeatable.',
+        )
+        parser.add_argument('--queued', action='store_true', help='Only render what catalog changes queued, if anything.')
+        parser.add_argument('--loop', action='store_true', help='With --queued, keep polling the queue instead of exiting.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        if not options['queued']:
+            self.report(snapshots.build(options['item_ids']))
+            return
+        while True:
+            manifest = snapshots.build_queued()
+            if manifest is not None:
+                self.report(manifest)
+            elif not options['loop']:
+                self.stdout.write('Nothing queued.')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+    def report(self, manifest):
+        encodings = ', '.join(manifest['encodings'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Snapshot {manifest['version']}: {len(manifest['files'])} documents, compressed as {encodings}."
+        ))
+        if snapshots.brotli is None:
+            self.stdout.write(self.style.WARNING('Install brotli to also write .br files.'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from main import cooccurrence
+
+
+class Command(BaseCommand):
+    help = 'Update the "frequently bought together" table from the orders placed since the last run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rescan every order instead of only the new ones.')
+        parser.add_argument('--metric', choices=cooccurrence.METRICS, default='jaccard', help='Pair score normalisation.')
+        parser.add_argument('--top-n', type=int, default=10, help='Number of related items to keep per item.')
+        parser.add_argument('--min-count', type=int, default=1, help='Minimum number of shared baskets for a pair.')
+
+    def handle(self, *args, **options):
+        baskets, items = cooccurrence.update(
+            full=options['full'],
+            metric=options['metric'],
+            top_n=options['top_n'],
+            min_count=options['min_count'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Scanned {baskets} new orders, rescored {items} items.'))
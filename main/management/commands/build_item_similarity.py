@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main import recommendations
+from main.models import ItemSimilarity
+
+
+class Command(BaseCommand):
+    help = 'Precompute the top-K most similar items of every active item into ItemSimilarity.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=10, help='Number of similar items to keep per item.')
+        parser.add_argument('--chunk-size', type=int, default=200, help='Number of items scored at once.')
+        parser.add_argument('--refit', action='store_true', help='Refit the TF-IDF model before computing.')
+        parser.add_argument('--if-stale', action='store_true', help='Only refit and compute if the catalog changed since the last fit.')
+
+    def handle(self, *args, **options):
+        stale = recommendations.get_stale_time() is not None or recommendations.get_current_version() is None
+        if options['if_stale'] and not stale:
+            self.stdout.write('The model is up to date.')
+            return
+        if options['refit'] or stale:
+            recommendations.build_model()
+        model = recommendations.get_model()
+        chunk_size = options['chunk_size']
+
+        total = 0
+        batch = {}
+        for item_id, similar in recommendations.iter_top_k(model, options['top_k'], chunk_size):
+            batch[item_id] = similar
+            if len(batch) >= chunk_size:
+                total += self.write(batch)
+                batch = {}
+        if batch:
+            total += self.write(batch)
+
+        ItemSimilarity.objects.filter(item__is_active=False).delete()
+        self.stdout.write(self.style.SUCCESS(f'Stored {total} similarities for {len(model.item_ids)} items.'))
+
+    def write(self, batch):
+        rows = [
+            ItemSimilarity(item_id=item_id, similar_item_id=similar_item_id, score=score, rank=rank)
+            for item_id, similar in batch.items()
+            for rank, (similar_item_id, score) in enumerate(similar)
+        ]
+        with transaction.atomic():
+            ItemSimilarity.objects.filter(item_id__in=list(batch)).delete()
+            ItemSimilarity.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
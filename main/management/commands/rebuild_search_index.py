@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from main import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full text search index of the active items.'
+
+    def handle(self, *args, **options):
+        if search.get_index() is None:
+            self.stdout.write(self.style.WARNING('This database has no full text index, search uses LIKE.'))
+            return
+        items = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {items} items.'))
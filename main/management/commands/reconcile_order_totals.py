@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main import cart
+
+
+class Command(BaseCommand):
+    help = 'Recompute the running totals of the open orders from their lines.'
+
+    def handle(self, *args, **options):
+        checked, fixed = cart.reconcile_totals()
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} open orders, fixed the totals of {fixed}.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main import stock
+
+
+class Command(BaseCommand):
+    help = 'Give the stock held by abandoned carts back once their reservation expired.'
+
+    def handle(self, *args, **options):
+        released = stock.release_expired()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired stock reservations.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main import popularity
+
+
+class Command(BaseCommand):
+    help = 'Recompute the time-decayed popularity of every item from the ordered lines.'
+
+    def handle(self, *args, **options):
+        items = popularity.rollup()
+        self.stdout.write(self.style.SUCCESS(f'Recomputed the popularity of {items} items.'))
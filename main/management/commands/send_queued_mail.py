@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import mail
+
+
+class Command(BaseCommand):
+    help = 'Send the mail queued in the outbox, in batches over one SMTP connection each.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Mails sent over one connection.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting once it is drained.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = mail.send_queued(options['batch_size'])
+            if sent or failed or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(f'Sent {sent} mails, {failed} failed.'))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+# Generated by Django 4.0.4 on 2026-10-18 04:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_alter_userhistory_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='main.item')),
+                ('similar_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.item')),
+            ],
+            options={
+                'verbose_name_plural': 'Item Similarities',
+                'ordering': ['item', 'rank'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='itemsimilarity',
+            constraint=models.UniqueConstraint(fields=('item', 'rank'), name='unique_item_similarity_rank'),
+        ),
+    ]
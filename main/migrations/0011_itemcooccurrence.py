@@ -0,0 +1,33 @@
+# Generated by Django 4.0.4 on 2026-10-18 05:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_itemsimilarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemCooccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('count', models.PositiveIntegerField()),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cooccurrences', to='main.item')),
+                ('related_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.item')),
+            ],
+            options={
+                'verbose_name_plural': 'Item Co-occurrences',
+                'ordering': ['item', 'rank'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='itemcooccurrence',
+            constraint=models.UniqueConstraint(fields=('item', 'rank'), name='unique_item_cooccurrence_rank'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.0.4 on 2026-10-18 05:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_itemcooccurrence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemPopularity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(db_index=True, default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='popularity', to='main.item')),
+            ],
+            options={
+                'verbose_name_plural': 'Item Popularities',
+            },
+        ),
+    ]
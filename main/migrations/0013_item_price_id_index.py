@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 06:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_itempopularity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['price', 'id'], name='main_item_price_id_idx'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+from django.db import migrations
+from django.utils.html import strip_tags
+
+
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE main_item_search USING fts5("
+    "name, brand, category, description, tokenize = 'porter unicode61 remove_diacritics 2')"
+)
+SQLITE_INSERT = 'INSERT INTO main_item_search (rowid, name, brand, category, description) VALUES (%s, %s, %s, %s, %s)'
+
+# no foreign key to main_item: Django does not know this table, so it would not be
+# truncated along with main_item on flush. The signals keep it in sync instead.
+POSTGRES_CREATE = (
+    'CREATE TABLE main_item_search ('
+    'item_id integer PRIMARY KEY, '
+    'document tsvector NOT NULL)',
+    'CREATE INDEX main_item_search_document_idx ON main_item_search USING GIN (document)',
+)
+POSTGRES_INSERT = (
+    "INSERT INTO main_item_search (item_id, document) VALUES (%s, "
+    "setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'B') || "
+    "setweight(to_tsvector('english', %s), 'B') || setweight(to_tsvector('english', %s), 'D'))"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements, insert = (SQLITE_CREATE,), SQLITE_INSERT
+    elif vendor == 'postgresql':
+        statements, insert = POSTGRES_CREATE, POSTGRES_INSERT
+    else:
+        # no full text index, search falls back to LIKE
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+    Item = apps.get_model('main', 'Item')
+    items = Item.objects.filter(is_active=True).select_related('brand', 'category').order_by('pk')
+    documents = [
+        (
+            item.pk,
+            item.name,
+            item.brand.name if item.brand else '',
+            item.category.name if item.category else '',
+            strip_tags(item.description or ''),
+        )
+        for item in items.iterator(chunk_size=500)
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(insert, documents)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE main_item_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_item_price_id_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # other databases use the in-process trigram index of main.fuzzy
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX main_item_name_trgm_idx ON main_item USING GIN (name gin_trgm_ops)')
+    schema_editor.execute('CREATE INDEX main_brand_name_trgm_idx ON main_brand USING GIN (name gin_trgm_ops)')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX main_item_name_trgm_idx')
+    schema_editor.execute('DROP INDEX main_brand_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_item_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations, models
+from django.db.models import Count, F, FloatField, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
+
+
+def fill_order_totals(apps, schema_editor):
+    Order = apps.get_model('main', 'Order')
+    price = F('items__item__price')
+    final_price = Coalesce(NullIf(F('items__item__discount_price'), Value(0.0)), price)
+    orders = Order.objects.annotate(
+        line_subtotal=Coalesce(Sum(F('items__quantity') * final_price, output_field=FloatField()), Value(0.0)),
+        line_discount=Coalesce(Sum(F('items__quantity') * (price - final_price), output_field=FloatField()), Value(0.0)),
+        line_profit_loss=Coalesce(Sum('items__profit_loss'), Value(0.0)),
+        line_total=Count('items__id'),
+    ).only('id', 'ordered', 'total_profit_loss')
+    batch = []
+    for order in orders.iterator(chunk_size=1000):
+        order.subtotal = round(order.line_subtotal, 2)
+        order.discount = round(order.line_discount, 2)
+        order.line_count = order.line_total
+        if not order.ordered:
+            # placed orders keep the profit recorded at checkout
+            order.total_profit_loss = order.line_profit_loss
+        batch.append(order)
+        if len(batch) >= 1000:
+            Order.objects.bulk_update(batch, ['subtotal', 'discount', 'total_profit_loss', 'line_count'])
+            batch = []
+    if batch:
+        Order.objects.bulk_update(batch, ['subtotal', 'discount', 'total_profit_loss', 'line_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='line_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
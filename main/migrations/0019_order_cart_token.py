@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='cart_token',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+    ]
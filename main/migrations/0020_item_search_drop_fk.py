@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def drop_item_foreign_key(apps, schema_editor):
+    # the key 0014 used to create, see there
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE main_item_search DROP CONSTRAINT IF EXISTS main_item_search_item_id_fkey')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_order_cart_token'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_item_foreign_key, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Count, F, FloatField, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
 from django.shortcuts import reverse
 from django.utils.text import slugify
 from django.utils.html import mark_safe
@@ -34,6 +36,12 @@ PRODUCT_TYPES = (
     ('Accessories', 'Accessories')
 )
 
+EMAIL_STATUS = (
+    (0,"Pending"),
+    (1,"Sent"),
+    (2,"Failed")
+)
+
 OFFER_IMAGES = (
     ('SI', 'Slider Image'),
     ('BI', 'Banner Image')
@@ -190,6 +198,60 @@ class Item(models.Model):
         self.slug = slugify(self.name)
         super(Item, self).save(*args, **kwargs)
 
+    class Meta:
+        indexes = [
+            # keyset pagination seeks on (price, id) for the price sort orders
+            models.Index(fields=['price', 'id'], name='main_item_price_id_idx'),
+        ]
+
+
+class ItemSimilarity(models.Model):
+    item = models.ForeignKey(Item, related_name='similarities', on_delete=models.CASCADE)
+    similar_item = models.ForeignKey(Item, related_name='+', on_delete=models.CASCADE)
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    def __str__(self):
+        return f"{self.item} -> {self.similar_item}"
+
+    class Meta:
+        verbose_name_plural = "Item Similarities"
+        ordering = ['item', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'rank'], name='unique_item_similarity_rank'),
+        ]
+
+
+class ItemCooccurrence(models.Model):
+    item = models.ForeignKey(Item, related_name='cooccurrences', on_delete=models.CASCADE)
+    related_item = models.ForeignKey(Item, related_name='+', on_delete=models.CASCADE)
+    score = models.FloatField()
+    count = models.PositiveIntegerField()
+    rank = models.PositiveSmallIntegerField()
+
+    def __str__(self):
+        return f"{self.item} + {self.related_item}"
+
+    class Meta:
+        verbose_name_plural = "Item Co-occurrences"
+        ordering = ['item', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'rank'], name='unique_item_cooccurrence_rank'),
+        ]
+
+
+class ItemPopularity(models.Model):
+    item = models.OneToOneField(Item, related_name='popularity', on_delete=models.CASCADE)
+    # log2 of the time-decayed sales, see main.popularity
+    score = models.FloatField(default=0, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.item.name
+
+    class Meta:
+        verbose_name_plural = "Item Popularities"
+
 
 class Wishlist(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -210,18 +272,22 @@ class OrderItem(models.Model):
     ordered_date = models.DateTimeField(auto_now=True, null=True, blank=True)
 
     def __str__(self):
-        return f"{self.quantity} of {self.item.name}({self.size}x{self.color})"
+        return f"{self.quantity} of {self.item.name}({self.color})"
 
     def get_total_item_price(self):
         return self.quantity * self.item.price
 
-    def save(self, *args, **kwargs):
+    def compute_prices(self):
+        # also called before bulk writes, which bypass save()
         discount_price = float(0 if self.item.discount_price is None else self.item.discount_price)
         if discount_price != 0:
             self.selling_price = discount_price
         else:
             self.selling_price  = self.item.price
         self.profit_loss = (float(self.selling_price) - float(self.item.cost_price)) * float(self.quantity)
+
+    def save(self, *args, **kwargs):
+        self.compute_prices()
         super(OrderItem, self).save(*args, **kwargs)
 
     def get_total_discount_item_price(self):
@@ -236,6 +302,25 @@ class OrderItem(models.Model):
         return round(self.get_total_item_price(),2)
 
 
+class StockReservation(models.Model):
+    '''
+    Stock held by the cart of a user, already taken out of Item.stock_count. It
+    is given back when the cart shrinks or expires, and dropped once ordered.
+    '''
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    item = models.ForeignKey(Item, related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=0)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.quantity} of {self.item.name}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'item'], name='unique_stock_reservation_user_item'),
+        ]
+
+
 class PaymentMethod(models.Model):
     payment_name = models.CharField(max_length=100)
     payment_code = models.CharField(unique=True, max_length=3)
@@ -275,6 +360,23 @@ class Coupon(models.Model):
         return self.code
 
 
+def get_order_totals(prefix=''):
+    '''
+    Aggregates of the running totals of an order over its lines, `prefix` is the
+    path from the aggregated model to OrderItem ('items__' from Order). Lines are
+    priced like OrderItem.get_final_price, at the current item prices.
+    '''
+    quantity = F(prefix + 'quantity')
+    price = F(prefix + 'item__price')
+    final_price = Coalesce(NullIf(F(prefix + 'item__discount_price'), Value(0.0)), price)
+    return {
+        'subtotal': Coalesce(Sum(quantity * final_price, output_field=FloatField()), Value(0.0)),
+        'discount': Coalesce(Sum(quantity * (price - final_price), output_field=FloatField()), Value(0.0)),
+        'total_profit_loss': Coalesce(Sum(prefix + 'profit_loss'), Value(0.0)),
+        'line_count': Count(prefix + 'id'),
+    }
+
+
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     ref_code = models.CharField(max_length=20, blank=True, null=True)
@@ -289,6 +391,12 @@ class Order(models.Model):
     order_note = models.CharField(max_length=200, blank=True, null=True)
     status = models.IntegerField(choices=ORDER_STATUS, blank=True, null=True)
     total_profit_loss = models.FloatField(default=0)
+    # running totals of the lines, kept up to date by recalculate_totals()
+    subtotal = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    line_count = models.IntegerField(default=0)
+    # the cart of the cache cart store this order was placed from, unique so a cart is ordered once
+    cart_token = models.CharField(max_length=32, unique=True, blank=True, null=True)
 
     '''
     1. Item added to cart
@@ -304,23 +412,28 @@ class Order(models.Model):
     def __str__(self):
         return self.user.username
 
+    def recalculate_totals(self, save=True):
+        '''
+        Recomputes the running totals with one aggregate query. Call it in the
+        transaction that changed the lines, so the totals never disagree with them.
+        '''
+        totals = self.items.aggregate(**get_order_totals())
+        self.subtotal = round(totals['subtotal'], 2)
+        self.discount = round(totals['discount'], 2)
+        self.total_profit_loss = totals['total_profit_loss']
+        self.line_count = totals['line_count']
+        if save:
+            self.save(update_fields=['subtotal', 'discount', 'total_profit_loss', 'line_count'])
+
     def get_total_profit_loss(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.profit_loss
-        return total
+        return self.total_profit_loss
 
     def get_subtotal(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        return total
+        return self.subtotal
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        if self.coupon:
+        total = self.subtotal
+        if self.coupon_id:
             total -= self.coupon.amount
         return round(total, 2)
 
@@ -399,3 +512,29 @@ class Offer(models.Model):
     def image_tag(self):
         return mark_safe(f'<img src="{self.image.url}" width="50" height="50" />')
 
+
+class EmailOutbox(models.Model):
+    '''
+    Mail queued by the request that produces it, in its transaction, and sent
+    later by the send_queued_mail command. See main.mail.
+    '''
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipients = models.JSONField()
+    status = models.IntegerField(choices=EMAIL_STATUS, default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        verbose_name_plural = "Email Outbox"
+        indexes = [
+            # the worker picks the pending mail that is due, oldest first
+            models.Index(fields=['status', 'next_attempt_at'], name='main_emailoutbox_due_idx'),
+        ]
@@ -0,0 +1,41 @@
+from django.conf import settings
+
+from .caching import get_or_build
+from .models import ItemCategory, ItemSubCategory
+from .serializers import CategoryTreeSubCategorySerializer, ItemCategorySerializer
+
+
+NAVIGATION = 'navigation'
+
+
+def build_navigation():
+    '''The flat menu lists, subcategories reference their category in `categories` by id.'''
+    categories = ItemCategory.objects.filter(is_active=True)
+    subcategories = ItemSubCategory.objects.filter(is_active=True)
+    return {
+        'categories': ItemCategorySerializer(categories, many=True).data,
+        'subcategories': CategoryTreeSubCategorySerializer(subcategories, many=True).data,
+    }
+
+
+def build_category_tree():
+    '''
+    Active categories with their active subcategories nested, in two queries.
+    Subcategories reference their category by id instead of embedding it again.
+    '''
+    categories = ItemCategorySerializer(ItemCategory.objects.filter(is_active=True), many=True).data
+    subcategories = ItemSubCategory.objects.filter(is_active=True, category__is_active=True).order_by('id')
+    children = {}
+    for subcategory in CategoryTreeSubCategorySerializer(subcategories, many=True).data:
+        children.setdefault(subcategory['category'], []).append(subcategory)
+    for category in categories:
+        category['subcategories'] = children.get(category['id'], [])
+    return categories
+
+
+def get_navigation():
+    return get_or_build(NAVIGATION, 'menu', build_navigation, settings.NAVIGATION_CACHE_TIMEOUT)
+
+
+def get_category_tree():
+    return get_or_build(NAVIGATION, 'tree', build_category_tree, settings.NAVIGATION_CACHE_TIMEOUT)
@@ -1,5 +1,13 @@
+import binascii
+import json
+from base64 import b64decode, b64encode
+
+from django.core.exceptions import ValidationError
+from django.db.models import FloatField, IntegerField, Q
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
 class CustomPagination(pagination.PageNumberPagination):
 
@@ -21,4 +29,119 @@ class CustomPagination(pagination.PageNumberPagination):
             'from': self.get_from(),
             'to': self.get_to(),
             'results': data
-        })
\ No newline at end of file
+        })
+
+
+class KeysetPagination(pagination.BasePagination):
+    '''
+    Cursor pagination that seeks past the last row of the previous page instead of
+    using OFFSET, and never runs COUNT(*), so a deep page costs the same as the first.
+    The cursor is an opaque token holding the sort key of the last row returned.
+    '''
+    orderings = {
+        'newest': ('-id',),
+        'price_low': ('price', 'id'),
+        'price_high': ('-price', '-id'),
+    }
+    page_size = api_settings.PAGE_SIZE or 24
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, sort=None):
+        self.sort = sort if sort in self.orderings else 'newest'
+        self.ordering = self.orderings[self.sort]
+        self.next_cursor = None
+
+    def get_param(self, request, name):
+        value = request.query_params.get(name)
+        if value is None and hasattr(request.data, 'get'):
+            value = request.data.get(name)
+        return value
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(self.get_param(request, self.page_size_query_param) or self.page_size)
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, values):
+        data = json.dumps({'s': self.sort, 'v': values}, separators=(',', ':'))
+        return b64encode(data.encode('utf-8'), altchars=b'-_').decode('ascii')
+
+    def get_cursor_fields(self, model):
+        '''The model fields whose to_python checks each cursor value.'''
+        return [model._meta.get_field(field.lstrip('-')) for field in self.ordering]
+
+    def decode_cursor(self, cursor, model=None):
+        '''
+        The sort key a cursor holds, each value coerced by its field. A cursor that was
+        tampered with or is from another sort is a 404, never a database error.
+        '''
+        try:
+            data = json.loads(b64decode(cursor.encode('ascii'), altchars=b'-_'))
+            values = data['v']
+            if data['s'] != self.sort or not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            values = [field.to_python(value) for field, value in zip(self.get_cursor_fields(model), values)]
+            if None in values:
+                raise ValueError
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def seek(self, values):
+        # (a, b) > (x, y) written as a > x OR (a = x AND b > y), honouring each field's direction
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            condition |= Q(**equal, **{name + lookup: value})
+            equal[name] = value
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.get_param(request, self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.seek(self.decode_cursor(cursor, queryset.model)))
+
+        page = list(queryset[:page_size + 1])
+        if len(page) > page_size:
+            page = page[:page_size]
+            last = page[-1]
+            self.next_cursor = self.encode_cursor([getattr(last, field.lstrip('-')) for field in self.ordering])
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.next_cursor,
+            'results': data
+        })
+
+
+class SearchPagination(KeysetPagination):
+    '''
+    Keyset pagination over ranked search hits. `search(limit, after)` returns
+    (rank, id) pairs ordered by rank then id, starting after the `after` pair.
+    '''
+    orderings = {
+        'relevance': ('rank', 'id'),
+    }
+
+    def get_cursor_fields(self, model):
+        # the rank is not a model field
+        return [FloatField(), IntegerField()]
+
+    def paginate_hits(self, search, request):
+        page_size = self.get_page_size(request)
+        cursor = self.get_param(request, self.cursor_query_param)
+        hits = search(page_size + 1, self.decode_cursor(cursor) if cursor else None)
+        if len(hits) > page_size:
+            hits = hits[:page_size]
+            self.next_cursor = self.encode_cursor(list(hits[-1]))
+        return hits
@@ -0,0 +1,122 @@
+import math
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Item, ItemPopularity, OrderItem
+
+
+# Popularity decays exponentially: a sale is worth half as much after every half life.
+# Instead of decaying every row over time, each sale is weighted by 2 ** (time since a
+# fixed epoch / half life). All rows then decay by the same factor, so ordering by the
+# stored value is the decayed ranking at any moment. The value is kept as log2 of that
+# sum, which never overflows however far we get from the epoch.
+EPOCH = datetime(2022, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def get_half_life():
+    return settings.POPULARITY_HALF_LIFE_DAYS * 86400
+
+
+def log2_weight(quantity, when):
+    return math.log2(quantity) + (when - EPOCH).total_seconds() / get_half_life()
+
+
+def log2_add(a, b):
+    if a is None:
+        return b
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def decayed_score(score, now=None):
+    now = now or timezone.now()
+    return 2 ** (score - (now - EPOCH).total_seconds() / get_half_life())
+
+
+def record_sales(lines, when=None):
+    '''Adds (item_id, quantity) sales made at `when` to the popularity table.'''
+    when = when or timezone.now()
+    sold = defaultdict(int)
+    for item_id, quantity in lines:
+        if quantity > 0:
+            sold[item_id] += quantity
+    if not sold:
+        return
+
+    with transaction.atomic():
+        # lock in item order so concurrent checkouts cannot deadlock on each other
+        current = {
+            popularity.item_id: popularity
+            for popularity in ItemPopularity.objects.select_for_update().filter(item_id__in=sold).order_by('item_id')
+        }
+        created, updated = [], []
+        for item_id in sorted(sold):
+            weight = log2_weight(sold[item_id], when)
+            if item_id in current:
+                popularity = current[item_id]
+                popularity.score = log2_add(popularity.score, weight)
+                popularity.updated_at = when
+                updated.append(popularity)
+            else:
+                created.append(ItemPopularity(item_id=item_id, score=weight))
+        ItemPopularity.objects.bulk_update(updated, ['score', 'updated_at'])
+        try:
+            with transaction.atomic():
+                ItemPopularity.objects.bulk_create(created)
+        except IntegrityError:
+            # a concurrent checkout recorded the first sale of one of them meanwhile
+            for popularity in created:
+                add_first_sale(popularity)
+
+
+def add_first_sale(popularity):
+    '''Inserts the row, or adds its score to the row another transaction inserted first.'''
+    try:
+        with transaction.atomic():
+            popularity.save(force_insert=True)
+    except IntegrityError:
+        current = ItemPopularity.objects.select_for_update().get(item_id=popularity.item_id)
+        current.score = log2_add(current.score, popularity.score)
+        current.save(update_fields=['score', 'updated_at'])
+
+
+def record_order(order, lines=None):
+    '''`lines` are the order lines when the caller already loaded them.'''
+    if lines is None:
+        sales = order.items.values_list('item_id', 'quantity')
+    else:
+        sales = [(line.item_id, line.quantity) for line in lines]
+    record_sales(sales, order.ordered_date)
+
+
+def rollup(batch_size=1000):
+    '''Recomputes every score from the ordered lines, e.g. after changing the half life.'''
+    scores = {}
+    lines = OrderItem.objects.filter(ordered=True).values_list('item_id', 'quantity', 'ordered_date')
+    for item_id, quantity, ordered_date in lines.iterator(chunk_size=batch_size):
+        if quantity > 0 and ordered_date is not None:
+            scores[item_id] = log2_add(scores.get(item_id), log2_weight(quantity, ordered_date))
+
+    with transaction.atomic():
+        existing = dict(ItemPopularity.objects.values_list('item_id', 'pk'))
+        stale = [pk for item_id, pk in existing.items() if item_id not in scores]
+        for start in range(0, len(stale), batch_size):
+            ItemPopularity.objects.filter(pk__in=stale[start:start + batch_size]).delete()
+        now = timezone.now()
+        rows = [ItemPopularity(pk=existing.get(item_id), item_id=item_id, score=score, updated_at=now) for item_id, score in scores.items()]
+        ItemPopularity.objects.bulk_update([row for row in rows if row.pk], ['score', 'updated_at'], batch_size=batch_size)
+        ItemPopularity.objects.bulk_create([row for row in rows if not row.pk], batch_size=batch_size)
+    return len(scores)
+
+
+def get_popular_items(count=8):
+    popular = ItemPopularity.objects.filter(item__is_active=True).select_related('item').order_by('-score')[:count]
+    popular_items = [popularity.item for popularity in popular]
+    if len(popular_items) < count:
+        rem_items = Item.objects.filter(is_active=True).exclude(pk__in=[item.pk for item in popular_items]).order_by('-id')
+        popular_items += list(rem_items[:count - len(popular_items)])
+    return popular_items
@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+from django.utils.html import strip_tags
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from .models import Item
+
+
+CURRENT_FILE = 'CURRENT'
+STALE_FILE = 'STALE'
+BUILDING_PREFIX = 'building-'
+ARRAYS = ('item_ids', 'csr_data', 'csr_indices', 'csr_indptr', 'csc_data', 'csc_indices', 'csc_indptr', 'idf')
+
+_lock = threading.Lock()
+_model = None
+
+
+def get_model_dir():
+    return settings.RECOMMENDATION_MODEL_DIR
+
+
+def get_current_version():
+    try:
+        with open(os.path.join(get_model_dir(), CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def mark_stale():
+    '''Flags the model for the next `build_item_similarity --if-stale` run, cheap enough for a request.'''
+    model_dir = get_model_dir()
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, STALE_FILE), 'a'):
+        pass
+    os.utime(os.path.join(model_dir, STALE_FILE))
+
+
+def get_stale_time():
+    '''When the model was last flagged stale, None if it is up to date.'''
+    try:
+        return os.path.getmtime(os.path.join(get_model_dir(), STALE_FILE))
+    except FileNotFoundError:
+        return None
+
+
+class RecommendationModel:
+    '''
+    TF-IDF model of the active item descriptions, loaded from disk with mmap.
+    Rows are L2 normalised, so a dot product between two rows is their cosine similarity.
+    The CSC copy is an inverted index (term -> items) used to score a single item
+    without touching the postings of terms it does not contain.
+    '''
+
+    def __init__(self, version):
+        self.version = version
+        path = os.path.join(get_model_dir(), version)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ARRAYS}
+        with open(os.path.join(path, 'vocabulary.json')) as f:
+            self.vocabulary = json.load(f)
+        self.item_ids = arrays['item_ids']
+        self.idf = arrays['idf']
+        shape = (len(self.item_ids), len(self.idf))
+        self.matrix = sp.csr_matrix((arrays['csr_data'], arrays['csr_indices'], arrays['csr_indptr']), shape=shape, copy=False)
+        self.postings = sp.csc_matrix((arrays['csc_data'], arrays['csc_indices'], arrays['csc_indptr']), shape=shape, copy=False)
+
+    def get_row(self, item_id):
+        row = int(np.searchsorted(self.item_ids, item_id))
+        if row < len(self.item_ids) and self.item_ids[row] == item_id:
+            return row
+        return None
+
+    def similar_item_ids(self, item_id, count=10):
+        row = self.get_row(item_id)
+        if row is None:
+            return []
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        terms, weights = self.matrix.indices[start:end], self.matrix.data[start:end]
+        if not len(terms):
+            return []
+        scores = np.asarray(self.postings[:, terms] @ weights).ravel()
+        scores[row] = -1
+        count = min(count, len(scores) - 1)
+        if count <= 0:
+            return []
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [int(self.item_ids[i]) for i in top]
+
+
+def build_model():
+    '''Refits the model from the catalog. Changes flagged while it runs leave it stale.'''
+    started_at = time.time()
+    items = Item.objects.filter(is_active=True).order_by('id').values_list('id', 'description')
+    item_ids = np.array([item_id for item_id, _ in items], dtype=np.int64)
+    documents = [strip_tags(description or '') for _, description in items]
+
+    tfidf = TfidfVectorizer(stop_words='english', dtype=np.float32)
+    try:
+        matrix = tfidf.fit_transform(documents).tocsr()
+        vocabulary = {term: int(index) for term, index in tfidf.vocabulary_.items()}
+        idf = tfidf.idf_.astype(np.float32)
+    except ValueError:
+        # empty catalog, or no description has a usable term
+        matrix = sp.csr_matrix((len(item_ids), 0), dtype=np.float32)
+        vocabulary = {}
+        idf = np.zeros(0, dtype=np.float32)
+    matrix.sort_indices()
+    postings = matrix.tocsc()
+    postings.sort_indices()
+
+    arrays = {
+        'item_ids': item_ids,
+        'csr_data': matrix.data, 'csr_indices': matrix.indices, 'csr_indptr': matrix.indptr,
+        'csc_data': postings.data, 'csc_indices': postings.indices, 'csc_indptr': postings.indptr,
+        'idf': idf,
+    }
+    version = save_model(arrays, vocabulary)
+    stale_time = get_stale_time()
+    if stale_time is not None and stale_time < started_at:
+        try:
+            os.remove(os.path.join(get_model_dir(), STALE_FILE))
+        except FileNotFoundError:
+            pass
+    return version
+
+
+def save_model(arrays, vocabulary):
+    model_dir = get_model_dir()
+    version = uuid.uuid4().hex
+    # written under another name and renamed once complete, so the prune of a
+    # concurrent build never takes it for a finished version nobody uses
+    building = os.path.join(model_dir, BUILDING_PREFIX + version)
+    os.makedirs(building)
+    for name, array in arrays.items():
+        np.save(os.path.join(building, name + '.npy'), np.ascontiguousarray(array))
+    with open(os.path.join(building, 'vocabulary.json'), 'w') as f:
+        json.dump(vocabulary, f)
+    os.rename(building, os.path.join(model_dir, version))
+
+    # swap the pointer atomically so readers never see a half written model
+    previous = get_current_version()
+    tmp_file = os.path.join(model_dir, CURRENT_FILE + '.' + version)
+    with open(tmp_file, 'w') as f:
+        f.write(version)
+    os.replace(tmp_file, os.path.join(model_dir, CURRENT_FILE))
+
+    prune(keep=(version, previous))
+    return version
+
+
+def prune(keep):
+    '''
+    Removes the model versions not in `keep`. Versions younger than
+    RECOMMENDATION_PRUNE_GRACE are left alone: processes may still have a recent
+    one mapped, and a build in progress keeps its directory young while it writes.
+    '''
+    model_dir = get_model_dir()
+    cutoff = time.time() - settings.RECOMMENDATION_PRUNE_GRACE
+    for name in os.listdir(model_dir):
+        path = os.path.join(model_dir, name)
+        if name in keep or not os.path.isdir(path):
+            continue
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def get_model():
+    '''The current model, None until build_item_similarity built the first one.'''
+    global _model
+    version = get_current_version()
+    if version is None:
+        return None
+    if _model is not None and _model.version == version:
+        return _model
+    with _lock:
+        version = get_current_version()
+        if _model is None or _model.version != version:
+            _model = RecommendationModel(version)
+        return _model
+
+
+def get_similar_item_ids(item_id, count=10):
+    model = get_model()
+    return model.similar_item_ids(item_id, count) if model is not None else []
+
+
+def iter_top_k(model, k=10, chunk_size=200):
+    '''
+    Yields (item_id, [(similar_item_id, score), ...]) for every item in the model.
+    Similarities are computed for chunk_size rows at a time, so memory is bounded
+    by chunk_size x number of items no matter how big the catalog is.
+    '''
+    item_ids = model.item_ids
+    # transposing the CSC copy gives a CSR (terms x items) matrix without copying
+    terms_by_item = model.postings.T
+    for start in range(0, len(item_ids), chunk_size):
+        end = min(start + chunk_size, len(item_ids))
+        scores = (model.matrix[start:end] @ terms_by_item).tocsr()
+        for offset in range(end - start):
+            row = start + offset
+            row_start, row_end = scores.indptr[offset], scores.indptr[offset + 1]
+            columns = scores.indices[row_start:row_end]
+            values = scores.data[row_start:row_end]
+            keep = (columns != row) & (values > 0)
+            columns, values = columns[keep], values[keep]
+            if len(values) > k:
+                top = np.argpartition(-values, k - 1)[:k]
+                columns, values = columns[top], values[top]
+            order = np.argsort(-values, kind='stable')
+            yield int(item_ids[row]), [(int(item_ids[c]), float(v)) for c, v in zip(columns[order], values[order])]
@@ -0,0 +1,113 @@
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from rest_framework import status
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from rest_framework.response import Response
+
+from .caching import get_version
+from .conditional import CATALOG, get_period
+from .models import Item, Wishlist
+
+
+def get_key(request, refresh_every=None):
+    query = sorted(request.query_params.lists())
+    path = hashlib.md5(repr((request.path, query)).encode()).hexdigest()
+    return f'response:{get_version(CATALOG)}:{get_period(refresh_every)}:{path}'
+
+
+def apply_wishlist(data, wishlist_ids):
+    '''Sets is_wishlist on every serialized item found in data.'''
+    if isinstance(data, dict):
+        if 'is_wishlist' in data:
+            data['is_wishlist'] = data.get('id') in wishlist_ids
+        for value in data.values():
+            apply_wishlist(value, wishlist_ids)
+    elif isinstance(data, list):
+        for value in data:
+            apply_wishlist(value, wishlist_ids)
+    return data
+
+
+def find_items(data, field, found):
+    '''Appends every serialized item of data holding `field` to found.'''
+    if isinstance(data, dict):
+        if field in data and 'id' in data:
+            found.append(data)
+        for value in data.values():
+            find_items(value, field, found)
+    elif isinstance(data, list):
+        for value in data:
+            find_items(value, field, found)
+    return found
+
+
+def apply_stock(data):
+    '''
+    Sets the current stock_count on every serialized item found in data. Carts
+    take and give back stock with queryset updates that bump no version, the
+    count in a cached body would go stale.
+    '''
+    items = find_items(data, 'stock_count', [])
+    if items:
+        stock = dict(Item.objects.filter(pk__in={item['id'] for item in items}).values_list('id', 'stock_count'))
+        for item in items:
+            item['stock_count'] = stock.get(item['id'], item['stock_count'])
+    return data
+
+
+def cache_response(timeout=None, refresh_every=None):
+    '''
+    Caches the body of a GET view once for everybody, keyed by the catalog version
+    so catalog changes invalidate it. The body is always built as for an anonymous
+    user, the only per-user part of it, is_wishlist, is laid over it per request.
+    The stock counts in it are read again on every hit, see apply_stock.
+
+    refresh_every: the body also holds data refreshed every that many seconds
+    without a version bump (popular items), it is rebuilt that often.
+    '''
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = get_key(request, refresh_every)
+            data = cache.get(key)
+            if data is None:
+                user = request.user
+                request.user = AnonymousUser()
+                try:
+                    response = view(request, *args, **kwargs)
+                finally:
+                    request.user = user
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                data = response.data
+                cache.set(key, data, timeout or refresh_every or settings.RESPONSE_CACHE_TIMEOUT)
+            else:
+                data = apply_stock(data)
+
+            if request.user.is_authenticated:
+                wishlist_ids = set(Wishlist.objects.filter(user=request.user).values_list('item_id', flat=True))
+                data = apply_wishlist(data, wishlist_ids)
+            return Response(data, status=status.HTTP_200_OK)
+        return wrapper
+    return decorator
+
+
+def private_response(view):
+    '''
+    Marks the responses of a view whose body or ETag depends on the user: shared
+    caches must not store them and a browser must not reuse them across logins.
+    Put it above condition() so its 304 responses carry the headers as well.
+    '''
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        patch_vary_headers(response, ('Authorization', 'Cookie'))
+        patch_cache_control(response, private=True)
+        return response
+    return wrapper
@@ -0,0 +1,155 @@
+import re
+
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.utils.html import strip_tags
+
+from .models import Item
+
+
+TABLE = 'main_item_search'
+BATCH_SIZE = 500
+
+
+class SQLiteIndex:
+    '''
+    FTS5 table keyed by the item id (rowid). bm25() is lower for better matches,
+    name hits weigh the most, then brand and category, then the description.
+    '''
+    match_sql = f'SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s'
+    ranked_sql = f'SELECT rowid AS item_id, bm25({TABLE}, 10.0, 4.0, 4.0, 1.0) AS rank FROM {TABLE} WHERE {TABLE} MATCH %s'
+    insert_sql = f'INSERT INTO {TABLE} (rowid, name, brand, category, description) VALUES (%s, %s, %s, %s, %s)'
+    delete_sql = f'DELETE FROM {TABLE} WHERE rowid IN ({{}})'
+    clear_sql = f'DELETE FROM {TABLE}'
+
+    def parse(self, tokens):
+        # every word has to match, the last one as a prefix since the user may still be typing
+        return ' '.join(f'"{token}"' for token in tokens) + '*'
+
+    def ranked_params(self, query):
+        return [query]
+
+
+class PostgresIndex:
+    '''
+    tsvector column with a GIN index. Postgres has no BM25, the rank is the negated
+    ts_rank_cd (cover density) so that lower is better, as with SQLite.
+    '''
+    match_sql = f"SELECT item_id FROM {TABLE} WHERE document @@ to_tsquery('english', %s)"
+    ranked_sql = (
+        f"SELECT item_id, -ts_rank_cd(document, to_tsquery('english', %s)) AS rank "
+        f"FROM {TABLE} WHERE document @@ to_tsquery('english', %s)"
+    )
+    insert_sql = (
+        f"INSERT INTO {TABLE} (item_id, document) VALUES (%s, "
+        "setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'B') || "
+        "setweight(to_tsvector('english', %s), 'B') || setweight(to_tsvector('english', %s), 'D'))"
+    )
+    delete_sql = f'DELETE FROM {TABLE} WHERE item_id IN ({{}})'
+    clear_sql = f'DELETE FROM {TABLE}'
+
+    def parse(self, tokens):
+        return ' & '.join(tokens) + ':*'
+
+    def ranked_params(self, query):
+        return [query, query]
+
+
+INDEXES = {
+    'sqlite': SQLiteIndex(),
+    'postgresql': PostgresIndex(),
+}
+
+
+def get_index():
+    # other databases have no index and fall back to LIKE
+    return INDEXES.get(connection.vendor)
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def get_documents(items):
+    items = items.select_related('brand', 'category').only('name', 'description', 'brand__name', 'category__name')
+    for item in items.iterator(chunk_size=BATCH_SIZE):
+        yield (
+            item.pk,
+            item.name,
+            item.brand.name if item.brand else '',
+            item.category.name if item.category else '',
+            strip_tags(item.description or ''),
+        )
+
+
+def write(index, cursor, documents):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= BATCH_SIZE:
+            cursor.executemany(index.insert_sql, batch)
+            batch = []
+    if batch:
+        cursor.executemany(index.insert_sql, batch)
+
+
+def update_index(item_ids):
+    '''Re-indexes the given items, inactive or deleted ones are dropped from the index.'''
+    index = get_index()
+    item_ids = list(item_ids)
+    if index is None or not item_ids:
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(item_ids), BATCH_SIZE):
+            batch = item_ids[start:start + BATCH_SIZE]
+            cursor.execute(index.delete_sql.format(', '.join(['%s'] * len(batch))), batch)
+        write(index, cursor, get_documents(Item.objects.filter(pk__in=item_ids, is_active=True)))
+
+
+def rebuild_index():
+    index = get_index()
+    if index is None:
+        return 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(index.clear_sql)
+        write(index, cursor, get_documents(Item.objects.filter(is_active=True).order_by('pk')))
+    return Item.objects.filter(is_active=True).count()
+
+
+def filter_matching(items, text):
+    '''Restricts the `items` queryset to the items matching the search text.'''
+    index = get_index()
+    tokens = tokenize(text)
+    if not tokens:
+        return items.none()
+    if index is None:
+        return items.filter(name__icontains=text)
+    return items.filter(pk__in=RawSQL(index.match_sql, [index.parse(tokens)]))
+
+
+def search_items(text, limit, after=None):
+    '''
+    Returns up to `limit` (rank, item_id) pairs best match first, ties broken by id.
+    `after` is the (rank, item_id) of the last hit of the previous page.
+    '''
+    index = get_index()
+    tokens = tokenize(text)
+    if not tokens:
+        return []
+    if index is None:
+        items = Item.objects.filter(name__icontains=text, is_active=True).order_by('id')
+        if after is not None:
+            items = items.filter(id__gt=after[1])
+        return [(0.0, item_id) for item_id in items.values_list('id', flat=True)[:limit]]
+
+    query = index.parse(tokens)
+    sql = f'SELECT item_id, rank FROM ({index.ranked_sql}) hits'
+    params = index.ranked_params(query)
+    if after is not None:
+        sql += ' WHERE rank > %s OR (rank = %s AND item_id > %s)'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY rank, item_id LIMIT %s'
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(rank, item_id) for item_id, rank in cursor.fetchall()]
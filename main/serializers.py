@@ -1,22 +1,112 @@
 from users.serializers import UserSerializer
 from .models import *
+from django.db.models import Model, QuerySet, prefetch_related_objects
 from rest_framework import serializers
 
 
+def nested(prefix, lookups):
+    return tuple(prefix + lookup for lookup in lookups)
+
+
+class EagerLoadingMixin:
+    '''
+    Serializers declare the relations they render, and every queryset, list or
+    instance handed to them is loaded with that plan, so the number of queries
+    does not grow with the number of rows serialized.
+    '''
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def get_eager_loading_plan(cls, fields=None):
+        select_related, prefetch_related = cls.select_related_fields, cls.prefetch_related_fields
+        if fields is not None:
+            # relations of fields left out of a sparse fieldset are not loaded
+            select_related = tuple(lookup for lookup in select_related if lookup.split('__')[0] in fields)
+            prefetch_related = tuple(lookup for lookup in prefetch_related if lookup.split('__')[0] in fields)
+        return select_related, prefetch_related
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields=None):
+        select_related, prefetch_related = cls.get_eager_loading_plan(fields)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+    @classmethod
+    def eager_load(cls, data, fields=None):
+        if isinstance(data, QuerySet):
+            return cls.setup_eager_loading(data, fields)
+        if isinstance(data, Model):
+            data = [data]
+        if isinstance(data, (list, tuple)) and data and isinstance(data[0], Model):
+            # already fetched rows cannot be joined any more, prefetch the relations instead
+            select_related, prefetch_related = cls.get_eager_loading_plan(fields)
+            prefetch_related_objects(data, *select_related, *prefetch_related)
+        return data
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        fields = kwargs.get('fields')
+        if args:
+            args = (cls.eager_load(args[0], fields),) + args[1:]
+        elif 'instance' in kwargs:
+            kwargs['instance'] = cls.eager_load(kwargs['instance'], fields)
+        return super().many_init(*args, **kwargs)
+
+    def __init__(self, instance=None, *args, **kwargs):
+        if isinstance(instance, Model):
+            self.eager_load(instance, kwargs.get('fields'))
+        super().__init__(instance, *args, **kwargs)
+
+
+class SparseFieldsMixin:
+    '''Takes fields=[...] to render only those fields, e.g. from a ?fields= parameter.'''
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class WishlistMixin:
+
+    def get_wishlist_ids(self):
+        # resolved once and kept in the context, so every item of the request shares it
+        if 'wishlist_ids' not in self.context:
+            user_id = self.context.get("user_id")
+            wishlist_ids = Wishlist.objects.filter(user_id=user_id).values_list('item_id', flat=True) if user_id else []
+            self.context['wishlist_ids'] = set(wishlist_ids)
+        return self.context['wishlist_ids']
+
+    def is_wishlist_added(self, obj):
+        return obj.id in self.get_wishlist_ids()
+
+
 class ItemCategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = ItemCategory
         fields = ('__all__')
 
 
-class ItemSubCategorySerializer(serializers.ModelSerializer):
+class ItemSubCategorySerializer(EagerLoadingMixin, serializers.ModelSerializer):
     category = ItemCategorySerializer()
+    select_related_fields = ('category',)
 
     class Meta:
         model = ItemSubCategory
         fields = ('__all__')
         
 
+class CategoryTreeSubCategorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ItemSubCategory
+        fields = ('id', 'category', 'name', 'slug', 'is_active')
+
+
 class BrandSerializer(serializers.ModelSerializer):
     class Meta:
         model = Brand
@@ -35,42 +125,59 @@ class ItemImageSerializer(serializers.ModelSerializer):
         fields = ('__all__')
         
 
-class ItemSerializer(serializers.ModelSerializer):
+class ItemSerializer(WishlistMixin, EagerLoadingMixin, SparseFieldsMixin, serializers.ModelSerializer):
     category = ItemCategorySerializer()
     subcategory = ItemSubCategorySerializer()
     brand = BrandSerializer()
     color = ColorSerializer(many=True)
     images = ItemImageSerializer(many=True)
     is_wishlist = serializers.SerializerMethodField('is_wishlist_added')
-    
-    def is_wishlist_added(self, obj):
-        user_id = self.context.get("user_id")
-        if user_id:
-            for wishlist in Wishlist.objects.filter(user__id=user_id):
-                if obj.id == wishlist.item.id:
-                    return True
-            else:
-                return False
-        return False
+    select_related_fields = ('category', 'subcategory__category', 'brand')
+    prefetch_related_fields = ('color', 'images')
 
     class Meta:
         model = Item
         fields = ('__all__')
+
+
+class ItemCardSerializer(WishlistMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    '''What a product grid shows, without the description and the nested relations.'''
+    thumbnail = serializers.SerializerMethodField()
+    is_wishlist = serializers.SerializerMethodField('is_wishlist_added')
+    prefetch_related_fields = ('images',)
+
+    def get_thumbnail(self, obj):
+        image = next(iter(obj.images.all()), None)
+        return image.image.url if image and image.image else None
+
+    class Meta:
+        model = Item
+        fields = ('id', 'name', 'slug', 'price', 'discount_price', 'thumbnail', 'is_wishlist')
         
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()
     item = ItemSerializer()
     color = ColorSerializer()
+    select_related_fields = ('user', 'color', 'item', *nested('item__', ItemSerializer.select_related_fields))
+    prefetch_related_fields = (
+        *nested('user__', UserSerializer.prefetch_related_fields),
+        *nested('item__', ItemSerializer.prefetch_related_fields),
+    )
 
     class Meta:
         model = OrderItem
         fields = ('__all__')
         
 
-class WishlistSerializer(serializers.ModelSerializer):
+class WishlistSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()
     item = ItemSerializer()
+    select_related_fields = ('user', 'item', *nested('item__', ItemSerializer.select_related_fields))
+    prefetch_related_fields = (
+        *nested('user__', UserSerializer.prefetch_related_fields),
+        *nested('item__', ItemSerializer.prefetch_related_fields),
+    )
 
     class Meta:
         model = Wishlist
@@ -83,8 +190,10 @@ class PaymentMethodSerializer(serializers.ModelSerializer):
         fields = ('__all__')
         
 
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()
+    select_related_fields = ('user',)
+    prefetch_related_fields = nested('user__', UserSerializer.prefetch_related_fields)
 
     class Meta:
         model = Address
@@ -97,20 +206,38 @@ class CouponSerializer(serializers.ModelSerializer):
         fields = ('__all__')
         
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()
     items = OrderItemSerializer(many=True)
     shipping_address = AddressSerializer()
     payment = PaymentMethodSerializer()
     coupon = CouponSerializer()
+    select_related_fields = ('user', 'payment', 'coupon', 'shipping_address', *nested('shipping_address__', AddressSerializer.select_related_fields))
+    prefetch_related_fields = (
+        *nested('user__', UserSerializer.prefetch_related_fields),
+        *nested('shipping_address__', AddressSerializer.prefetch_related_fields),
+        'items',
+        *nested('items__', OrderItemSerializer.select_related_fields + OrderItemSerializer.prefetch_related_fields),
+    )
 
     class Meta:
         model = Order
         fields = ('__all__')
         
 
-class RefundSerializer(serializers.ModelSerializer):
+class CartOrderSerializer(OrderSerializer):
+    '''An order of the cache cart store, its lines are passed in the context as they are not rows yet.'''
+    items = serializers.SerializerMethodField()
+    prefetch_related_fields = tuple(lookup for lookup in OrderSerializer.prefetch_related_fields if lookup.split('__')[0] != 'items')
+
+    def get_items(self, order):
+        return OrderItemSerializer(self.context['lines'], many=True).data
+
+
+class RefundSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     order = OrderSerializer()
+    select_related_fields = ('order', *nested('order__', OrderSerializer.select_related_fields))
+    prefetch_related_fields = nested('order__', OrderSerializer.prefetch_related_fields)
 
     class Meta:
         model = Refund
@@ -129,17 +256,24 @@ class ContactSerializer(serializers.ModelSerializer):
         fields = ('__all__')
         
 
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()
     item = ItemSerializer()
+    select_related_fields = ('user', 'item', *nested('item__', ItemSerializer.select_related_fields))
+    prefetch_related_fields = (
+        *nested('user__', UserSerializer.prefetch_related_fields),
+        *nested('item__', ItemSerializer.prefetch_related_fields),
+    )
 
     class Meta:
         model = Review
         fields = ('__all__')
         
 
-class PostSerializer(serializers.ModelSerializer):
+class PostSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     author = UserSerializer()
+    select_related_fields = ('author',)
+    prefetch_related_fields = nested('author__', UserSerializer.prefetch_related_fields)
 
     class Meta:
         model = Post
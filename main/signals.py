@@ -0,0 +1,159 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import recommendations, search, snapshots
+from .caching import bump_version
+from .conditional import CATALOG, wishlist_namespace
+from .facets import FACETS
+from .fuzzy import FUZZY
+from .models import Brand, Color, Item, ItemCategory, ItemImage, ItemSubCategory, Post, Review, Wishlist
+from .navigation import NAVIGATION
+from .suggest import SUGGEST
+
+
+def rebuild_recommendations():
+    # refitting reads the whole catalog, build_item_similarity --if-stale does it off the request
+    transaction.on_commit(recommendations.mark_stale)
+
+
+@receiver(pre_save, sender=Item)
+def track_item_corpus_change(sender, instance, **kwargs):
+    # only the descriptions of active items feed the recommendation model
+    if instance.pk is None:
+        instance._corpus_changed = instance.is_active
+        return
+    previous = Item.objects.filter(pk=instance.pk).values('description', 'is_active').first()
+    if previous is None:
+        instance._corpus_changed = instance.is_active
+    else:
+        instance._corpus_changed = (
+            previous['is_active'] != instance.is_active
+            or (instance.is_active and previous['description'] != instance.description)
+        )
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, **kwargs):
+    if getattr(instance, '_corpus_changed', True):
+        rebuild_recommendations()
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    if instance.is_active:
+        rebuild_recommendations()
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def reindex_item(sender, instance, **kwargs):
+    # the pk is cleared once a delete completes, read it now
+    item_id = instance.pk
+    transaction.on_commit(lambda: search.update_index([item_id]))
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=ItemCategory)
+def reindex_related_items(sender, instance, created, **kwargs):
+    # brand and category names are part of the indexed documents
+    if created:
+        return
+    related = 'brand' if sender is Brand else 'category'
+    item_ids = list(Item.objects.filter(**{related: instance}).values_list('pk', flat=True))
+    transaction.on_commit(lambda: search.update_index(item_ids))
+
+
+@receiver(post_save, sender=ItemCategory)
+@receiver(post_delete, sender=ItemCategory)
+@receiver(post_save, sender=ItemSubCategory)
+@receiver(post_delete, sender=ItemSubCategory)
+def navigation_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(NAVIGATION))
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(m2m_changed, sender=Item.color.through)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Color)
+@receiver(post_delete, sender=Color)
+def facets_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(FACETS))
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=ItemCategory)
+@receiver(post_delete, sender=ItemCategory)
+def suggestions_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(SUGGEST))
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+def fuzzy_index_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(FUZZY))
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(m2m_changed, sender=Item.color.through)
+@receiver(m2m_changed, sender=Item.images.through)
+@receiver(post_save, sender=ItemCategory)
+@receiver(post_delete, sender=ItemCategory)
+@receiver(post_save, sender=ItemSubCategory)
+@receiver(post_delete, sender=ItemSubCategory)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Color)
+@receiver(post_delete, sender=Color)
+@receiver(post_save, sender=ItemImage)
+@receiver(post_delete, sender=ItemImage)
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def catalog_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(CATALOG))
+
+
+@receiver(post_save, sender=Wishlist)
+@receiver(post_delete, sender=Wishlist)
+def wishlist_changed(sender, instance, **kwargs):
+    namespace = wishlist_namespace(instance.user_id)
+    transaction.on_commit(lambda: bump_version(namespace))
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def snapshot_item_pages(sender, instance, **kwargs):
+    if settings.CATALOG_SNAPSHOT_ON_CHANGE:
+        item_ids = [instance.item_id if sender is Review else instance.pk]
+        transaction.on_commit(lambda: snapshots.queue(item_ids))
+
+
+@receiver(post_save, sender=ItemCategory)
+@receiver(post_delete, sender=ItemCategory)
+@receiver(post_save, sender=ItemSubCategory)
+@receiver(post_delete, sender=ItemSubCategory)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Color)
+@receiver(post_delete, sender=Color)
+@receiver(post_save, sender=ItemImage)
+@receiver(post_delete, sender=ItemImage)
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def snapshot_catalog(sender, **kwargs):
+    # shown on many product pages, render them all again
+    if settings.CATALOG_SNAPSHOT_ON_CHANGE:
+        transaction.on_commit(snapshots.queue)
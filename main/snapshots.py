@@ -0,0 +1,236 @@
+import fcntl
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Item, ItemCategory, ItemCooccurrence, ItemSimilarity, Post
+from .navigation import get_navigation
+from .renderers import FastJSONRenderer
+from .serializers import ItemCardSerializer, ItemCategorySerializer, ItemSerializer, PostSerializer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+CURRENT_LINK = 'current'
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = '.lock'
+QUEUE_FILE = '.queue'
+BUILDING_PREFIX = 'building-'
+ALL = '*'
+ANONYMOUS = {'user_id': None}
+
+
+def get_snapshot_dir():
+    return settings.CATALOG_SNAPSHOT_DIR
+
+
+def get_encodings():
+    return ('.gz', '.br') if brotli else ('.gz',)
+
+
+def compress(data, encoding):
+    if encoding == '.gz':
+        # no timestamp in the header, so the same document always compresses to the same bytes
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+
+def read_manifest(version):
+    try:
+        with open(os.path.join(get_snapshot_dir(), version, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def get_current_version():
+    try:
+        return os.path.basename(os.readlink(os.path.join(get_snapshot_dir(), CURRENT_LINK)))
+    except (FileNotFoundError, OSError):
+        return None
+
+
+@contextmanager
+def lock():
+    '''Serializes builds across every process sharing the snapshot directory.'''
+    snapshot_dir = get_snapshot_dir()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, LOCK_FILE), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def queue(item_ids=None):
+    '''
+    Asks the next `build_catalog_snapshot --queued` run for the product pages of
+    item_ids, or for everything. Cheap enough to call from a request.
+    '''
+    snapshot_dir = get_snapshot_dir()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    lines = [str(item_id) for item_id in item_ids] if item_ids is not None else [ALL]
+    # one short append per call, concurrent writers do not interleave within it
+    with open(os.path.join(snapshot_dir, QUEUE_FILE), 'a') as f:
+        f.write(''.join(line + '\n' for line in lines))
+
+
+def build_queued():
+    '''Builds what was queued, returns the manifest or None if nothing was.'''
+    snapshot_dir = get_snapshot_dir()
+    with lock():
+        queue_file = os.path.join(snapshot_dir, QUEUE_FILE)
+        try:
+            # later queue() calls start a new file, they are left for the next run
+            os.rename(queue_file, f'{queue_file}.{uuid.uuid4().hex}')
+        except FileNotFoundError:
+            pass
+        # with the ones a crashed run took and did not build
+        taken = glob.glob(glob.escape(queue_file) + '.*')
+        if not taken:
+            return None
+        lines = set()
+        for name in taken:
+            with open(name) as f:
+                lines.update(line.strip() for line in f if line.strip())
+        item_ids = None if ALL in lines else {int(line) for line in lines}
+        manifest = _build(item_ids)
+        for name in taken:
+            os.remove(name)
+        return manifest
+
+
+def get_affected_item_ids(item_ids):
+    '''The changed items and the items whose detail page lists one of them.'''
+    item_ids = set(item_ids)
+    item_ids |= set(ItemSimilarity.objects.filter(similar_item_id__in=item_ids).values_list('item_id', flat=True))
+    item_ids |= set(ItemCooccurrence.objects.filter(related_item_id__in=item_ids).values_list('item_id', flat=True))
+    return item_ids
+
+
+def iter_documents(changed_item_ids=None, reuse=()):
+    '''
+    Yields (path, payload) of every public document, the payload is None for a
+    product page that did not change and can be reused from the previous snapshot.
+    The payloads are the bodies the API serves to anonymous users.
+    '''
+    from .views import get_item_detail
+
+    navigation = get_navigation()
+    yield 'categories.json', {'categories': navigation['categories'], 'subcategories': navigation['subcategories']}
+
+    posts = Post.objects.filter(status=1).order_by('-created_on')
+    yield 'blogs.json', {
+        'blogs': PostSerializer(posts, many=True).data,
+        'categories': navigation['categories'],
+        'subcategories': navigation['subcategories'],
+    }
+
+    for category in ItemCategory.objects.filter(is_active=True).exclude(slug=None):
+        items = Item.objects.filter(is_active=True, category=category).order_by('-id')
+        yield f'category/{category.slug}.json', {
+            'category': ItemCategorySerializer(category).data,
+            'items': ItemCardSerializer(items, many=True, context=ANONYMOUS).data,
+        }
+
+    items = ItemSerializer.setup_eager_loading(Item.objects.filter(is_active=True).exclude(slug=None)).order_by('id')
+    for item in items.iterator(chunk_size=200):
+        path = f'product/{item.slug}.json'
+        if changed_item_ids is not None and item.id not in changed_item_ids and path in reuse:
+            yield path, None
+        else:
+            yield path, get_item_detail(item, ANONYMOUS)
+
+
+def link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def build(item_ids=None):
+    '''
+    Renders the catalog to a new snapshot directory and points `current` at it.
+    Every document is written as .json and precompressed next to it. A document
+    whose bytes did not change since the previous snapshot is hard linked from it
+    instead of being compressed again. With item_ids, only the product pages of
+    those items (and of the items showing them) are rendered, the other product
+    pages are linked from the previous snapshot.
+    '''
+    with lock():
+        return _build(item_ids)
+
+
+def _build(item_ids):
+    snapshot_dir = get_snapshot_dir()
+    previous = get_current_version()
+    encodings = get_encodings()
+    previous_manifest = read_manifest(previous) if previous else None
+    if previous_manifest is None or previous_manifest['encodings'] != list(encodings):
+        # nothing to reuse, or it lacks an encoding (brotli installed since)
+        previous_files = {}
+        item_ids = None
+    else:
+        previous_files = previous_manifest['files']
+    changed_item_ids = get_affected_item_ids(item_ids) if item_ids is not None else None
+
+    created = timezone.now()
+    version = f'{created:%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}'
+    # written under another name and renamed once complete
+    path = os.path.join(snapshot_dir, BUILDING_PREFIX + version)
+    os.makedirs(path)
+    renderer = FastJSONRenderer()
+
+    files = {}
+    for name, payload in iter_documents(changed_item_ids, previous_files):
+        target = os.path.join(path, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if payload is None:
+            files[name] = previous_files[name]
+        else:
+            data = renderer.render(payload)
+            files[name] = {'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+
+        if files[name] == previous_files.get(name):
+            # unchanged, link the previous files instead of compressing again
+            source = os.path.join(snapshot_dir, previous, name)
+            for suffix in ('',) + encodings:
+                link_or_copy(source + suffix, target + suffix)
+            continue
+
+        with open(target, 'wb') as f:
+            f.write(data)
+        for suffix in encodings:
+            with open(target + suffix, 'wb') as f:
+                f.write(compress(data, suffix))
+
+    manifest = {'version': version, 'created': created.isoformat(), 'encodings': encodings, 'files': files}
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path, os.path.join(snapshot_dir, version))
+
+    # swap the link atomically so the web server never serves a half written snapshot
+    tmp_link = os.path.join(snapshot_dir, CURRENT_LINK + '.' + version)
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, os.path.join(snapshot_dir, CURRENT_LINK))
+
+    # keep the previous version around for responses still being served from it,
+    # no other build runs while the lock is held so the rest is unused
+    for name in os.listdir(snapshot_dir):
+        old_path = os.path.join(snapshot_dir, name)
+        if name not in (version, previous) and os.path.isdir(old_path) and not os.path.islink(old_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+    return manifest
@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Item, StockReservation
+
+
+class OutOfStock(Exception):
+    pass
+
+
+def take(item_id, quantity):
+    '''
+    Takes `quantity` out of the stock of an item unless fewer are left. The check
+    and the decrement are one UPDATE ... WHERE stock_count >= quantity, so
+    concurrent takes can never drive the stock below zero.
+    '''
+    return Item.objects.filter(pk=item_id, stock_count__gte=quantity).update(stock_count=F('stock_count') - quantity) == 1
+
+
+def give_back(item_id, quantity):
+    Item.objects.filter(pk=item_id).update(stock_count=F('stock_count') + quantity)
+
+
+def reserve(user, quantities):
+    '''
+    Makes the stock reserved for `user` match `quantities`, item id -> quantity of
+    their whole cart: the shortfall is taken from the stock, the excess and the
+    items left out are given back, and every reservation gets a new expiry.
+    Items are handled by ascending id so that concurrent transactions lock the
+    item rows in the same order and cannot deadlock. Raises OutOfStock and
+    rolls back all of it if one item runs short.
+    '''
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TIMEOUT)
+    with transaction.atomic():
+        held = {
+            reservation.item_id: reservation
+            for reservation in StockReservation.objects.select_for_update().filter(user=user).order_by('item_id')
+        }
+        created, updated, released = [], [], []
+        for item_id in sorted(set(held) | set(quantities)):
+            wanted = quantities.get(item_id, 0)
+            reservation = held.get(item_id)
+            current = reservation.quantity if reservation else 0
+            if wanted > current and not take(item_id, wanted - current):
+                name = Item.objects.filter(pk=item_id).values_list('name', flat=True).first()
+                raise OutOfStock(f'Not enough {name} in stock.')
+            if wanted < current:
+                give_back(item_id, current - wanted)
+
+            if wanted <= 0:
+                if reservation:
+                    released.append(reservation.pk)
+            elif reservation:
+                reservation.quantity, reservation.expires_at = wanted, expires_at
+                updated.append(reservation)
+            else:
+                created.append(StockReservation(user=user, item_id=item_id, quantity=wanted, expires_at=expires_at))
+
+        if released:
+            StockReservation.objects.filter(pk__in=released).delete()
+        if updated:
+            StockReservation.objects.bulk_update(updated, ['quantity', 'expires_at'])
+        if created:
+            StockReservation.objects.bulk_create(created)
+
+
+def consume(user):
+    '''Drops the reservations of an order being placed, their stock is sold.'''
+    StockReservation.objects.filter(user=user).delete()
+
+
+def release_expired(batch_size=500):
+    '''Gives the stock of expired reservations back, returns how many were released.'''
+    released = 0
+    while True:
+        with transaction.atomic():
+            # skip reservations a checkout is busy with, they are no longer expired after it
+            reservations = list(
+                StockReservation.objects.select_for_update(skip_locked=True)
+                .filter(expires_at__lte=timezone.now()).order_by('id')[:batch_size]
+            )
+            if not reservations:
+                return released
+            quantities = {}
+            for reservation in reservations:
+                quantities[reservation.item_id] = quantities.get(reservation.item_id, 0) + reservation.quantity
+            for item_id in sorted(quantities):
+                give_back(item_id, quantities[item_id])
+            StockReservation.objects.filter(pk__in=[reservation.pk for reservation in reservations]).delete()
+            released += len(reservations)
@@ -0,0 +1,150 @@
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .caching import get_version
+from .models import Brand, Item, ItemCategory, ItemPopularity
+from .popularity import decayed_score
+
+
+SUGGEST = 'suggest'
+SUGGEST_COUNT = 10
+# prefixes up to this length match too many keys to scan, their answers are precomputed
+PRECOMPUTED_LENGTH = 3
+
+logger = logging.getLogger(__name__)
+
+# held while a rebuild runs
+_lock = threading.Lock()
+_index = None
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+class SuggestIndex:
+    '''
+    Sorted array of the normalized names and of every word suffix of them, so
+    "shoe" completes "Red Running Shoe". Completions of a prefix are the contiguous
+    run of keys starting with it, found with two binary searches. Entries are
+    numbered by descending weight, so the best completions are the lowest numbers.
+    '''
+
+    def __init__(self, entries, version):
+        self.version = version
+        self.built_at = time.monotonic()
+        entries = sorted(entries, key=lambda entry: -entry[0])
+        self.entries = [entry[1] for entry in entries]
+
+        pairs = []
+        for number, (_, suggestion) in enumerate(entries):
+            words = normalize(suggestion['name']).split()
+            for start in range(len(words)):
+                pairs.append((' '.join(words[start:]), number))
+        self.top = {}
+        # pairs are still in weight order here
+        for key, number in pairs:
+            for length in range(1, min(len(key), PRECOMPUTED_LENGTH) + 1):
+                top = self.top.setdefault(key[:length], [])
+                if len(top) < SUGGEST_COUNT and number not in top:
+                    top.append(number)
+
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.refs = [number for _, number in pairs]
+
+    def complete(self, text, count=SUGGEST_COUNT):
+        prefix = normalize(text)
+        if not prefix:
+            return []
+        count = min(count, SUGGEST_COUNT)
+        if len(prefix) <= PRECOMPUTED_LENGTH:
+            numbers = self.top.get(prefix, [])[:count]
+        else:
+            start = bisect_left(self.keys, prefix)
+            end = bisect_left(self.keys, prefix + '\uffff', start)
+            numbers = heapq.nsmallest(count, set(self.refs[start:end]))
+        return [self.entries[number] for number in numbers]
+
+
+def get_entries():
+    '''(weight, suggestion) of every active item, brand and category.'''
+    now = timezone.now()
+    item_weights = {
+        item_id: decayed_score(score, now)
+        for item_id, score in ItemPopularity.objects.filter(item__is_active=True).values_list('item_id', 'score')
+    }
+    brand_weights, category_weights = {}, {}
+    entries = []
+    items = Item.objects.filter(is_active=True).values_list('id', 'name', 'slug', 'brand_id', 'category_id')
+    for item_id, name, slug, brand_id, category_id in items.iterator(chunk_size=2000):
+        weight = item_weights.get(item_id, 0)
+        # a brand or category is as popular as the items it holds
+        brand_weights[brand_id] = brand_weights.get(brand_id, 0) + weight
+        category_weights[category_id] = category_weights.get(category_id, 0) + weight
+        entries.append((weight, {'type': 'item', 'id': item_id, 'name': name, 'slug': slug}))
+
+    for brand_id, name, slug in Brand.objects.filter(is_active=True).values_list('id', 'name', 'slug'):
+        entries.append((brand_weights.get(brand_id, 0), {'type': 'brand', 'id': brand_id, 'name': name, 'slug': slug}))
+    for category_id, name, slug in ItemCategory.objects.filter(is_active=True).values_list('id', 'name', 'slug'):
+        entries.append((category_weights.get(category_id, 0), {'type': 'category', 'id': category_id, 'name': name, 'slug': slug}))
+    return entries
+
+
+def rebuild():
+    '''Builds the index from the database and makes it the one this process answers from.'''
+    global _index
+    # read before the entries, a bump during the build leaves the new index stale
+    version = get_version(SUGGEST)
+    _index = SuggestIndex(get_entries(), version)
+    return _index
+
+
+def start_rebuild():
+    '''
+    Rebuilds the index in a background thread unless one already is, returns
+    whether it started one. Called at startup from the WSGI and ASGI modules.
+    '''
+    if not _lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            rebuild()
+        except Exception:
+            logger.exception('Could not build the suggest index.')
+        finally:
+            connection.close()
+            _lock.release()
+
+    threading.Thread(target=run, name='suggest-index', daemon=True).start()
+    return True
+
+
+def get_index():
+    '''
+    The index of this process, rebuilt when the catalog version was bumped and
+    at least every SUGGEST_INDEX_MAX_AGE seconds to pick up popularity changes.
+    Rebuilds run in the background, requests keep the previous index meanwhile
+    and get None only before the first build finished.
+    '''
+    index = _index
+    if index is None or index.version != get_version(SUGGEST) or time.monotonic() - index.built_at >= settings.SUGGEST_INDEX_MAX_AGE:
+        start_rebuild()
+    return index
+
+
+def suggest(text, count=SUGGEST_COUNT):
+    index = get_index()
+    return index.complete(text, count) if index is not None else []
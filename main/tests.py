@@ -1,3 +1,980 @@
-from django.test import TestCase
+import os
+import io
+import json
+import random
+import smtplib
+import tempfile
+import threading
+import time
+import unittest
+from base64 import b64encode
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.test import APIClient
+
+from . import caching, cooccurrence, fuzzy, popularity, recommendations, renderers, search, snapshots, suggest, views
+from .cart import TOTAL_FIELDS, CartError, get_cart_store, get_line_totals, sync_cart
+from .checks import check_cart_cache
+from .conditional import CATALOG
+from .facets import count_facets, get_facet_summary
+from .mail import FAILED, PENDING, SENT, queue_mail, send_queued
+from .models import (
+    Address, Brand, Color, EmailOutbox, Item, ItemCategory, ItemCooccurrence, ItemPopularity, ItemSimilarity,
+    ItemSubCategory, Order, OrderItem, Review, StockReservation, Wishlist,
+)
+from .navigation import NAVIGATION, get_navigation
+from .renderers import FastJSONRenderer
+from .search import search_items
+from .serializers import ItemSerializer
+from .stock import release_expired
+from .views import place_order, save_order_db
+
+
+_data_dir = None
+
+
+def setUpModule():
+    # models, counts and snapshots the tests build never land in BASE_DIR/data
+    global _data_dir
+    _data_dir = tempfile.TemporaryDirectory()
+    override = override_settings(
+        RECOMMENDATION_MODEL_DIR=os.path.join(_data_dir.name, 'recommendations'),
+        COOCCURRENCE_STATE_DIR=os.path.join(_data_dir.name, 'cooccurrence'),
+        CATALOG_SNAPSHOT_DIR=os.path.join(_data_dir.name, 'snapshots'),
+    )
+    override.enable()
+    unittest.addModuleCleanup(override.disable)
+    unittest.addModuleCleanup(_data_dir.cleanup)
+
+
+def run_in_threads(target, args_list):
+    '''
+    Runs target(*args) for each args in parallel threads started together and
+    returns what each returned or raised. The in-memory SQLite test database
+    fails conflicting writes at once where other databases wait for the row
+    lock, so those are retried.
+    '''
+    barrier = threading.Barrier(len(args_list))
+    results = [None] * len(args_list)
+
+    def run(index, args):
+        barrier.wait()
+        try:
+            while True:
+                try:
+                    results[index] = target(*args)
+                    break
+                except OperationalError:
+                    time.sleep(random.random() / 20)
+                except Exception as e:
+                    results[index] = e
+                    break
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(index, args)) for index, args in enumerate(args_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def create_item(name, price=10, **fields):
+    fields.setdefault('description', 'd')
+    return Item.objects.create(name=name, price=price, cost_price=5, product_type='Mobile', **fields)
+
+
+def create_placed_order(user, items, ordered_date=None, quantity=1):
+    ordered_date = ordered_date or timezone.now()
+    order = Order.objects.create(user=user, ordered=True, ordered_date=ordered_date)
+    lines = [OrderItem(user=user, item=item, ordered=True, quantity=quantity) for item in items]
+    OrderItem.objects.bulk_create(lines)
+    # ordered_date is auto_now on the lines
+    OrderItem.objects.filter(pk__in=[line.pk for line in lines]).update(ordered_date=ordered_date)
+    order.items.add(*lines)
+    return order
+
+
+@override_settings(CART_STORE='cache')
+class StockReservationTests(TransactionTestCase):
+
+    def setUp(self):
+        caches[settings.CART_CACHE].clear()
+        self.item = Item.objects.create(name='Sale Shoe', price=100, cost_price=60, stock_count=5, product_type='Mobile', description='d')
+        self.users = [User.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(20)]
+
+    def test_add_to_cart_reserves_stock(self):
+        sync_cart(self.users[0], [{'item': self.item.slug, 'quantity': 3}])
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock_count, 2)
+
+        with self.assertRaises(CartError):
+            sync_cart(self.users[1], [{'item': self.item.slug, 'quantity': 3}])
+        sync_cart(self.users[0], [{'item': self.item.slug, 'quantity': 1}])
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock_count, 4)
+
+    def test_expired_reservations_are_released(self):
+        sync_cart(self.users[0], [{'item': self.item.slug, 'quantity': 2}])
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(release_expired(), 1)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock_count, 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_parallel_add_to_cart_never_oversells(self):
+        results = run_in_threads(sync_cart, [(user, [{'item': self.item.slug, 'add': 1}]) for user in self.users])
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock_count, 0)
+        self.assertEqual(sum(StockReservation.objects.values_list('quantity', flat=True)), 5)
+        self.assertEqual(results.count(None), 5)
+        self.assertTrue(all(isinstance(result, CartError) for result in results if result is not None))
+
+    def test_parallel_checkouts_never_oversell(self):
+        # every cart was filled while there was stock, then their reservations expired
+        Item.objects.filter(pk=self.item.pk).update(stock_count=len(self.users))
+        addresses = {}
+        for user in self.users:
+            sync_cart(user, [{'item': self.item.slug, 'quantity': 1}])
+            addresses[user.pk] = {'id': Address.objects.create(user=user, full_name='f', phone_number='1', street_address='s', apartment_address='a').id}
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        release_expired()
+        Item.objects.filter(pk=self.item.pk).update(stock_count=5)
+
+        results = run_in_threads(place_order, [(user, addresses[user.pk]) for user in self.users])
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock_count, 0)
+        self.assertEqual(Order.objects.filter(ordered=True).count(), 5)
+        self.assertFalse(Order.objects.filter(ordered=False).exists())
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(len([result for result in results if isinstance(result, CartError)]), 15)
+
+    def test_a_cart_is_ordered_once(self):
+        user = self.users[0]
+        address = {'id': Address.objects.create(user=user, full_name='f', phone_number='1', street_address='s', apartment_address='a').id}
+        sync_cart(user, [{'item': self.item.slug, 'quantity': 2}])
+        store = get_cart_store()
+        entry = store.get_cache().get(store.get_key(user))
+        place_order(user, address)
+        # a second worker that read the cart before the first checkout dropped it
+        store.get_cache().set(store.get_key(user), entry)
+        with self.assertRaises(CartError):
+            place_order(user, address)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock_count, 3)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertIsNone(store.get_cache().get(store.get_key(user)))
+
+    def test_the_cart_stays_locked_until_the_order_commits(self):
+        user = self.users[0]
+        address = {'id': Address.objects.create(user=user, full_name='f', phone_number='1', street_address='s', apartment_address='a').id}
+        store = get_cart_store()
+        lock_key = store.get_key(user) + ':lock'
+        sync_cart(user, [{'item': self.item.slug, 'quantity': 2}])
+        with transaction.atomic():
+            place_order(user, address)
+            # a sync now would be dropped with the ordered cart
+            self.assertIsNotNone(store.get_cache().get(lock_key))
+        self.assertIsNone(store.get_cache().get(lock_key))
+
+        sync_cart(user, [{'item': self.item.slug, 'add': 1}])
+        self.assertEqual(store.get_quantities(user), {(self.item.id, None): 1})
+        self.assertEqual(StockReservation.objects.get().quantity, 1)
+        # a checkout that fails gives the lock back at once
+        sync_cart(user, [{'item': self.item.slug, 'quantity': 0}])
+        with self.assertRaises(Order.DoesNotExist):
+            place_order(user, address)
+        self.assertIsNone(store.get_cache().get(lock_key))
+
+
+class CartStoreSettingsTests(TestCase):
+
+    def setUp(self):
+        caches[settings.CART_CACHE].clear()
+
+    def test_cache_store_reads_database_carts_once(self):
+        user = User.objects.create(username='switcher', email='switcher@example.com')
+        item = Item.objects.create(name='Old Cart Shoe', price=100, cost_price=60, stock_count=5, product_type='Mobile', description='d')
+        with override_settings(CART_STORE='database'):
+            sync_cart(user, [{'item': item.slug, 'quantity': 2}])
+        with override_settings(CART_STORE='cache'):
+            self.assertEqual(get_cart_store().get_quantities(user), {(item.id, None): 2})
+            self.assertFalse(Order.objects.filter(user=user).exists())
+            self.assertFalse(OrderItem.objects.filter(user=user).exists())
+            self.assertEqual(get_cart_store().get_quantities(user), {(item.id, None): 2})
+
+    def test_cache_store_needs_a_shared_cache(self):
+        with override_settings(CART_STORE='cache'):
+            self.assertEqual([error.id for error in check_cart_cache(None)], ['main.E001'])
+        self.assertEqual(check_cart_cache(None), [])
+
+
+class CartSyncTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches[settings.CART_CACHE].clear()
+        self.user = User.objects.create(username='syncer', email='syncer@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.shoe = create_item('Sync Shoe', price=100, stock_count=5)
+        self.sock = create_item('Sync Sock', price=10, stock_count=5)
+
+    def sync(self, operations):
+        return self.client.post('/cart-sync/', {'operations': operations}, format='json')
+
+    def test_bodies_without_an_operation_list_are_rejected(self):
+        for body in [[{'item': self.shoe.slug, 'quantity': 1}], {'operations': {'item': self.shoe.slug}}, {'operations': []}, {}]:
+            response = self.client.post('/cart-sync/', body, format='json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(self.sync(['shoe']).status_code, 400)
+
+    def test_an_invalid_operation_applies_none_of_them(self):
+        for store in ('database', 'cache'):
+            with self.subTest(store), override_settings(CART_STORE=store):
+                cache.clear()
+                response = self.sync([{'item': self.shoe.slug, 'quantity': 1}])
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()['subtotal'], 100)
+                for operations in [
+                    [{'item': self.sock.slug, 'quantity': 2}, {'item': 'missing', 'quantity': 1}],
+                    [{'item': self.sock.slug, 'quantity': 2}, {'item': self.shoe.slug, 'add': 10}],
+                ]:
+                    self.assertEqual(self.sync(operations).status_code, 400)
+                    self.assertEqual(get_cart_store().get_quantities(self.user), {(self.shoe.id, None): 1})
+                    self.assertEqual(dict(Item.objects.values_list('slug', 'stock_count')), {self.shoe.slug: 4, self.sock.slug: 5})
+                self.assertEqual(self.sync([{'item': self.shoe.slug, 'quantity': 0}]).status_code, 200)
+
+    def assert_totals_match_the_lines(self):
+        order = Order.objects.get(user=self.user, ordered=False)
+        expected = get_line_totals(list(order.items.select_related('item')))
+        for name in TOTAL_FIELDS:
+            self.assertAlmostEqual(getattr(order, name), expected[name], msg=name)
+        return order
+
+    def test_stored_totals_follow_every_change_of_the_lines(self):
+        Item.objects.filter(pk=self.sock.pk).update(discount_price=8)
+        for operations in [
+            [{'item': self.shoe.slug, 'quantity': 2}, {'item': self.sock.slug, 'add': 3}],
+            [{'item': self.sock.slug, 'add': -1}],
+            [{'item': self.shoe.slug, 'quantity': 0}],
+        ]:
+            self.assertEqual(self.sync(operations).status_code, 200)
+            self.assert_totals_match_the_lines()
+        order = self.assert_totals_match_the_lines()
+        self.assertEqual((order.subtotal, order.discount, order.line_count), (16, 4, 1))
+
+    def test_reconcile_command_fixes_totals_after_a_price_change(self):
+        self.sync([{'item': self.shoe.slug, 'quantity': 2}, {'item': self.sock.slug, 'quantity': 1}])
+        placed = create_placed_order(self.user, [self.shoe])
+        # a queryset update sends no signal, the stored totals go stale
+        Item.objects.filter(pk=self.shoe.pk).update(price=80)
+        self.assertEqual(Order.objects.get(user=self.user, ordered=False).subtotal, 210)
+        out = io.StringIO()
+        call_command('reconcile_order_totals', stdout=out)
+        self.assertIn('Checked 1 open orders, fixed the totals of 1.', out.getvalue())
+        self.assertEqual(self.assert_totals_match_the_lines().subtotal, 170)
+        # placed orders keep the totals they were charged
+        placed.refresh_from_db()
+        self.assertEqual(placed.subtotal, 0)
+
+
+class SaveOrderTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='buyer', email='buyer@example.com')
+        self.address = Address.objects.create(user=self.user, full_name='f', phone_number='1', street_address='s', apartment_address='a')
+
+    def create_order(self, size):
+        items = [
+            Item(name=f'Item {size} {i}', slug=f'item-{size}-{i}', price=100 + i, discount_price=90 if i % 2 else 0, cost_price=50, product_type='Mobile', description='d')
+            for i in range(size)
+        ]
+        Item.objects.bulk_create(items)
+        order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+        lines = [OrderItem(user=self.user, item=item, quantity=2) for item in items]
+        OrderItem.objects.bulk_create(lines)
+        order.items.add(*lines)
+        return order
+
+    def save_order(self, order):
+        with CaptureQueriesContext(connection) as queries:
+            save_order_db(order, 100.0, {'id': self.address.id})
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        small = self.save_order(self.create_order(1))
+        large = self.save_order(self.create_order(30))
+        self.assertEqual(small, large)
+        self.assertEqual(small, 13)
+
+    def test_lines_are_ordered_and_priced(self):
+        order = self.create_order(4)
+        self.save_order(order)
+        order.refresh_from_db()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.shipping_address, self.address)
+        lines = order.items.all()
+        self.assertTrue(all(line.ordered for line in lines))
+        self.assertEqual(sorted(line.selling_price for line in lines), [90, 90, 100, 102])
+        self.assertEqual(order.total_profit_loss, sum((line.selling_price - 50) * 2 for line in lines))
+
+
+class RecommendationTests(TransactionTestCase):
+
+    def setUp(self):
+        model_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(model_dir.cleanup)
+        self.enterContext(override_settings(RECOMMENDATION_MODEL_DIR=model_dir.name))
+        descriptions = ['red running shoe', 'blue running shoe', 'leather office chair', 'wooden office chair']
+        self.items = [
+            Item.objects.create(name=f'Similar {i}', price=10, cost_price=5, product_type='Mobile', description=description)
+            for i, description in enumerate(descriptions)
+        ]
+
+    def test_item_changes_flag_the_model_instead_of_refitting(self):
+        self.assertIsNotNone(recommendations.get_stale_time())
+        self.assertIsNone(recommendations.get_current_version())
+        self.assertEqual(recommendations.get_similar_item_ids(self.items[0].id), [])
+
+        call_command('build_item_similarity', '--if-stale', '--top-k', '1', stdout=io.StringIO())
+        self.assertIsNone(recommendations.get_stale_time())
+        self.assertEqual(recommendations.get_similar_item_ids(self.items[0].id, 1), [self.items[1].id])
+        self.assertEqual(
+            list(ItemSimilarity.objects.filter(item=self.items[2]).values_list('similar_item_id', flat=True)),
+            [self.items[3].id],
+        )
+        version = recommendations.get_current_version()
+        call_command('build_item_similarity', '--if-stale', stdout=io.StringIO())
+        self.assertEqual(recommendations.get_current_version(), version)
+
+        self.items[0].description = 'green running shoe'
+        self.items[0].save()
+        self.assertIsNotNone(recommendations.get_stale_time())
+        self.assertEqual(recommendations.get_current_version(), version)
+
+    def test_only_old_unused_versions_are_pruned(self):
+        model_dir = settings.RECOMMENDATION_MODEL_DIR
+        old, young = os.path.join(model_dir, 'old'), os.path.join(model_dir, recommendations.BUILDING_PREFIX + 'young')
+        os.makedirs(old)
+        os.makedirs(young)
+        past = time.time() - settings.RECOMMENDATION_PRUNE_GRACE - 60
+        os.utime(old, (past, past))
+        first = recommendations.build_model()
+        second = recommendations.build_model()
+        self.assertEqual(sorted(os.listdir(model_dir)), sorted([recommendations.CURRENT_FILE, first, second, os.path.basename(young)]))
+
+    def test_product_pages_list_the_precomputed_neighbours(self):
+        cache.clear()
+        call_command('build_item_similarity', stdout=io.StringIO())
+        # read from the table, the model is not loaded
+        with mock.patch.object(views, 'get_similar_item_ids') as from_model:
+            related = APIClient().get(f'/product/{self.items[0].slug}/').json()['related_products']
+        self.assertFalse(from_model.called)
+        self.assertEqual([entry['id'] for entry in related], [self.items[1].id])
+
+
+def encode_cursor(sort, values):
+    return b64encode(json.dumps({'s': sort, 'v': values}).encode(), altchars=b'-_').decode()
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        for i in range(3):
+            Item.objects.create(name=f'Page {i}', price=10 + i, cost_price=5, product_type='Mobile', description='d')
+
+    def get_pages(self, sort):
+        # also resets the rate limit
+        cache.clear()
+        ids, cursor = [], None
+        while True:
+            params = {'sort': sort, 'page_size': 2, **({'cursor': cursor} if cursor else {})}
+            response = self.client.get('/shop/', params).json()
+            self.assertLessEqual(len(response['items']), 2)
+            ids += [item['id'] for item in response['items']]
+            cursor = response['next_cursor']
+            if cursor is None:
+                return ids
+
+    def test_cursors_walk_every_item_once_in_sort_order(self):
+        # equal prices, the id breaks the ties
+        for i in range(4):
+            create_item(f'Tied {i}', price=11)
+        items = list(Item.objects.values_list('id', 'price'))
+        self.assertEqual(self.get_pages('newest'), sorted((item_id for item_id, _ in items), reverse=True))
+        self.assertEqual(self.get_pages('price_low'), [item_id for item_id, _ in sorted(items, key=lambda item: (item[1], item[0]))])
+        self.assertEqual(self.get_pages('price_high'), [item_id for item_id, _ in sorted(items, key=lambda item: (-item[1], -item[0]))])
+
+    def test_cursor_values_of_the_wrong_type_are_not_found(self):
+        for sort, values in [('newest', ['abc']), ('price_low', ['cheap', 1]), ('price_low', [None, 1]), ('newest', [[1]])]:
+            response = self.client.get('/shop/', {'sort': sort, 'cursor': encode_cursor(sort, values)})
+            self.assertEqual(response.status_code, 404, (sort, values))
+        response = self.client.post('/search/', {'search_q': 'page', 'cursor': encode_cursor('relevance', ['x', 1])}, format='json')
+        self.assertEqual(response.status_code, 404)
+        filters = {'filters': {'sort': 'price_low'}, 'cursor': encode_cursor('price_low', ['cheap', 1])}
+        response = self.client.post('/filter-product/', filters, format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+class CatalogViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = ItemCategory.objects.create(name='Phones', category_type='Mobile')
+        self.brands = [Brand.objects.create(name='Acme'), Brand.objects.create(name='Globex')]
+        self.colors = [Color.objects.create(name='Red', color_code='#f00'), Color.objects.create(name='Blue', color_code='#00f')]
+
+    def create_items(self, count):
+        items = []
+        for i in range(count):
+            item = create_item(f'Catalog {Item.objects.count()}', category=self.category, brand=self.brands[i % 2])
+            item.color.set(self.colors[:i % 2 + 1])
+            items.append(item)
+        return items
+
+    def count_queries(self, method, url, data=None):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_the_page(self):
+        self.create_items(2)
+        few = [self.count_queries('get', '/shop/'), self.count_queries('get', '/category/phones/')]
+        self.create_items(10)
+        self.assertEqual([self.count_queries('get', '/shop/'), self.count_queries('get', '/category/phones/')], few)
+
+    def test_grids_render_cards_or_the_requested_fields(self):
+        item, = self.create_items(1)
+        card, = self.client.get('/shop/').json()['items']
+        self.assertEqual(set(card), {'id', 'name', 'slug', 'price', 'discount_price', 'thumbnail', 'is_wishlist'})
+        self.assertEqual((card['id'], card['thumbnail'], card['is_wishlist']), (item.id, None, False))
+
+        # unknown names are left out, the known ones render as ItemSerializer does
+        items = self.client.get('/shop/', {'fields': 'id, description,nope'}).json()['items']
+        self.assertEqual(items, [{'id': item.id, 'description': item.description}])
+        search.rebuild_index()
+        items = self.client.post('/search/?fields=brand,slug', {'search_q': 'catalog'}, format='json').json()['items']
+        self.assertEqual([(set(entry), entry['brand']['name']) for entry in items], [({'brand', 'slug'}, 'Acme')])
+
+    def test_facet_counts_leave_out_their_own_selection(self):
+        self.create_items(3)
+        acme, globex = self.brands
+        counts = count_facets(Item.objects.filter(is_active=True), {'brands': [acme.slug]})
+        # picking a second brand widens the result, so both keep their own counts
+        self.assertEqual(counts['brands'], {acme.slug: 2, globex.slug: 1})
+        # the other facets are counted within the selected brand
+        self.assertEqual(counts['colors'], {'#f00': 2})
+        self.assertEqual(counts['categories'], {self.category.slug: 2})
+
+        response = self.client.post('/filter-product/', {'filters': {'colors': ['#00f']}}, format='json').json()
+        self.assertEqual(len(response['items']), 1)
+        self.assertEqual(response['facets']['brands'], {globex.slug: 1})
+
+    def test_facet_summary_is_cached_until_the_facets_change(self):
+        self.create_items(2)
+        Color.objects.create(name='Crimson', color_code='#f00')
+        summary = get_facet_summary()
+        self.assertEqual(summary['price_range'], {'min': {'price__min': 10}, 'max': {'price__max': 10}})
+        # one entry per color code
+        self.assertEqual([brand['name'] for brand in summary['brands']], ['Acme', 'Globex'])
+        self.assertEqual(sorted(color['color_code'] for color in summary['colors']), ['#00f', '#f00'])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_facet_summary(), summary)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_item('Catalog Pricey', price=99)
+        self.assertEqual(get_facet_summary()['price_range']['max'], {'price__max': 99})
+
+    def test_conditional_get_answers_304_until_the_catalog_changes(self):
+        self.create_items(1)
+        response = self.client.get('/shop/')
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/shop/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        caching.bump_version(CATALOG)
+        response = self.client.get('/shop/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_per_user_responses_are_private(self):
+        item, = self.create_items(1)
+        response = self.client.get('/shop/')
+        not_modified = self.client.get('/shop/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        for response in [response, not_modified, self.client.get(f'/product/{item.slug}/'), self.client.get('/category/phones/')]:
+            self.assertIn('private', response['Cache-Control'])
+            self.assertLessEqual({'Authorization', 'Cookie'}, {header.strip() for header in response['Vary'].split(',')})
+
+    def test_cached_responses_carry_each_users_wishlist(self):
+        liked, other = self.create_items(2)
+        fan, stranger = User.objects.create(username='fan'), User.objects.create(username='stranger')
+        Wishlist.objects.create(user=fan, item=liked)
+
+        def wishlist_flags(user):
+            self.client.force_authenticate(user)
+            items = self.client.get('/shop/').json()['items']
+            return {item['id']: item['is_wishlist'] for item in items}
+
+        self.assertEqual(wishlist_flags(None), {liked.id: False, other.id: False})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(wishlist_flags(fan), {liked.id: True, other.id: False})
+        # the body came from the cache, only the wishlist was read
+        self.assertFalse(any('main_item"' in query['sql'] and 'main_wishlist' not in query['sql'] for query in queries))
+        self.assertEqual(wishlist_flags(stranger), {liked.id: False, other.id: False})
+
+    def test_wishlist_is_read_once_per_serialization(self):
+        items = self.create_items(3)
+        fan = User.objects.create(username='fan')
+        Wishlist.objects.create(user=fan, item=items[1])
+        with CaptureQueriesContext(connection) as queries:
+            data = ItemSerializer(Item.objects.order_by('id'), many=True, context={'user_id': fan.id}).data
+        self.assertEqual([entry['is_wishlist'] for entry in data], [False, True, False])
+        self.assertEqual(len([query for query in queries if 'main_wishlist' in query['sql']]), 1)
+
+    def test_cached_item_pages_show_the_current_stock(self):
+        item = create_item('Stocked Phone', stock_count=5)
+        self.assertEqual(self.client.get(f'/product/{item.slug}/').json()['item']['stock_count'], 5)
+        # reserving stock updates the rows without bumping the catalog version
+        sync_cart(User.objects.create(username='buyer'), [{'item': item.slug, 'quantity': 2}])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(f'/product/{item.slug}/').json()['item']['stock_count'], 3)
+        self.assertEqual(len(queries), 1)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.phone = create_item('Galaxy Phone', description='A phone')
+        self.case = create_item('Leather Case', description='Fits the galaxy phone')
+        create_item('Desk Lamp', description='Bright')
+        search.rebuild_index()
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual([item_id for _, item_id in search_items('galaxy', 10)], [self.phone.id, self.case.id])
+        first = search_items('galaxy', 1)
+        self.assertEqual([item_id for _, item_id in search_items('galaxy', 10, first[0])], [self.case.id])
+        self.assertEqual([item_id for _, item_id in search_items('gal', 10)], [self.phone.id, self.case.id])
+
+    def test_index_follows_item_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.phone.name = 'Nebula Phone'
+            self.phone.save()
+        self.assertEqual([item_id for _, item_id in search_items('nebula', 10)], [self.phone.id])
+        self.assertEqual([item_id for _, item_id in search_items('galaxy', 10)], [self.case.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.case.is_active = False
+            self.case.save()
+        self.assertEqual(search_items('galaxy', 10), [])
+
+        phone_id = self.phone.id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.phone.delete()
+        self.assertEqual(search_items('nebula', 10), [])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM main_item_search WHERE rowid = %s', [phone_id])
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_misspelt_searches_fall_back_to_the_closest_names(self):
+        self.addCleanup(setattr, fuzzy, '_index', fuzzy._index)
+        fuzzy.rebuild()
+        response = self.client.post('/search/', {'search_q': 'galaxi fone'}, format='json').json()
+        self.assertEqual(response['items'][0]['id'], self.phone.id)
+        self.assertIsNotNone(response['fuzzy_scores'])
+
+        response = self.client.post('/search/', {'search_q': 'galaxy'}, format='json').json()
+        self.assertEqual([item['id'] for item in response['items']], [self.phone.id, self.case.id])
+        self.assertIsNone(response['fuzzy_scores'])
+
+    def test_queries_of_common_trigrams_still_find_names(self):
+        # every name contains the trigrams of "phone", none of them is rare
+        index = fuzzy.TrigramIndex([(i, f'Phone {i}') for i in range(1, 5000)] + [(5000, 'Phone')], version=0)
+        self.assertEqual(index.search('phone', 3)[0], (1.0, 5000))
+        self.assertEqual(len(index.search('phone', 3)), 3)
+        self.assertEqual(index.search('phoen', 1), [(0.5, 5000)])
+        self.assertEqual(index.search('xyz', 1), [])
+
+    def test_suggestions_complete_names_and_words_within_them(self):
+        self.addCleanup(setattr, suggest, '_index', suggest._index)
+        suggest.rebuild()
+        names = lambda q: [entry['name'] for entry in self.client.get('/suggest/', {'q': q}).json()['suggestions']]
+        self.assertEqual(names('gal'), ['Galaxy Phone'])
+        self.assertEqual(names('phon'), ['Galaxy Phone'])
+        self.assertEqual(names('LEATHER c'), ['Leather Case'])
+        self.assertEqual(names('xyz'), [])
+
+
+class RendererTests(TestCase):
+
+    def test_stdlib_fallback_renders_the_same_document(self):
+        data = {
+            'price': Decimal('9.90'),
+            'when': timezone.now(),
+            'name': gettext_lazy('Shop'),
+            'ids': {1: 'a'},
+            'text': 'line\u2028break',
+        }
+        fast = FastJSONRenderer().render(data)
+        with mock.patch.object(renderers, 'orjson', None):
+            fallback = FastJSONRenderer().render(data)
+        self.assertEqual(json.loads(fast), json.loads(fallback))
+        self.assertNotIn('\u2028'.encode(), fast)
+        self.assertNotIn('\u2028'.encode(), fallback)
+
+
+class CachingMemoTests(TestCase):
+
+    def test_unknown_product_types_get_no_cache_scope(self):
+        response = APIClient().get('/product-type/no-such-type/')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(any(name.startswith('product_type:no-such-type') for _, name in caching._current))
+        self.assertEqual(APIClient().get('/product-type/Mobile/').status_code, 200)
+
+    @override_settings(CACHING_MEMO_SIZE=3)
+    def test_memo_keeps_the_most_recently_used_payloads(self):
+        for i in range(5):
+            caching.get_or_build('memo-test', f'payload-{i}', lambda: {'i': i}, 60)
+        caching.get_or_build('memo-test', 'payload-2', lambda: None, 60)
+        caching.get_or_build('memo-test', 'payload-5', lambda: {'i': 5}, 60)
+        self.assertEqual(
+            [name for namespace, name in caching._current if namespace == 'memo-test'],
+            ['payload-4', 'payload-2', 'payload-5'],
+        )
+
+
+class SnapshotTests(TransactionTestCase):
+
+    def setUp(self):
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        self.enterContext(override_settings(CATALOG_SNAPSHOT_DIR=snapshot_dir.name, CATALOG_SNAPSHOT_ON_CHANGE=True))
+        self.category = ItemCategory.objects.create(name='Phones', category_type='Mobile', slug='phones')
+        self.item = Item.objects.create(name='Snap Phone', price=10, cost_price=5, product_type='Mobile', description='d', category=self.category)
+        self.user = User.objects.create(username='reviewer', email='reviewer@example.com')
+
+    def test_reviews_queue_a_snapshot_instead_of_building_it(self):
+        Review.objects.create(user=self.user, item=self.item, rating=5, description='good')
+        self.assertIsNone(snapshots.get_current_version())
+
+        manifest = snapshots.build_queued()
+        self.assertEqual(snapshots.get_current_version(), manifest['version'])
+        self.assertIn(f'product/{self.item.slug}.json', manifest['files'])
+        self.assertIsNone(snapshots.build_queued())
+
+    def test_concurrent_builds_keep_a_complete_current_snapshot(self):
+        results = run_in_threads(snapshots.build, [() for _ in range(4)])
+        self.assertTrue(all(isinstance(result, dict) for result in results))
+        snapshot_dir = settings.CATALOG_SNAPSHOT_DIR
+        current = snapshots.get_current_version()
+        self.assertEqual(snapshots.read_manifest(current)['version'], current)
+        self.assertTrue(os.path.exists(os.path.join(snapshot_dir, current, 'category', 'phones.json.gz')))
+        versions = [name for name in os.listdir(snapshot_dir) if os.path.isdir(os.path.join(snapshot_dir, name)) and name != 'current']
+        self.assertEqual(len(versions), 2)
+        self.assertFalse(any(name.startswith(snapshots.BUILDING_PREFIX) for name in versions))
+
+    def get_inode(self, name):
+        return os.stat(os.path.join(settings.CATALOG_SNAPSHOT_DIR, snapshots.CURRENT_LINK, name)).st_ino
+
+    def test_incremental_builds_render_only_the_changed_pages(self):
+        cases = ItemCategory.objects.create(name='Cases', category_type='Mobile', slug='cases')
+        case = create_item('Snap Case', category=cases)
+        snapshots.build()
+        pages = ['category/phones.json', 'category/cases.json', f'product/{self.item.slug}.json', f'product/{case.slug}.json']
+        before = {name: self.get_inode(name) for name in pages}
+
+        Item.objects.filter(pk=self.item.pk).update(price=12)
+        with mock.patch.object(views, 'get_item_detail', wraps=views.get_item_detail) as render:
+            manifest = snapshots.build([self.item.id])
+        self.assertEqual([call.args[0] for call in render.call_args_list], [self.item])
+        after = {name: self.get_inode(name) for name in pages}
+        # the unchanged pages are the previous files, linked
+        self.assertEqual(after[f'product/{case.slug}.json'], before[f'product/{case.slug}.json'])
+        self.assertEqual(after['category/cases.json'], before['category/cases.json'])
+        self.assertNotEqual(after[f'product/{self.item.slug}.json'], before[f'product/{self.item.slug}.json'])
+        self.assertNotEqual(after['category/phones.json'], before['category/phones.json'])
+        self.assertEqual(snapshots.get_current_version(), manifest['version'])
+
+    def test_queued_items_are_built_once_with_those_a_crashed_run_left(self):
+        # the items created in setUp queued everything
+        snapshots.build_queued()
+        case = create_item('Snap Case', category=self.category)
+        snapshots.build_queued()
+        snapshots.queue([self.item.id])
+        with open(os.path.join(settings.CATALOG_SNAPSHOT_DIR, snapshots.QUEUE_FILE + '.crashed'), 'w') as f:
+            f.write(f'{case.id}\n')
+        with mock.patch.object(views, 'get_item_detail', wraps=views.get_item_detail) as render:
+            self.assertIsNotNone(snapshots.build_queued())
+            self.assertEqual(sorted(call.args[0].id for call in render.call_args_list), sorted([self.item.id, case.id]))
+            self.assertIsNone(snapshots.build_queued())
+            render.reset_mock()
+            snapshots.queue()
+            snapshots.build_queued()
+            self.assertEqual(render.call_count, 2)
+        self.assertFalse([name for name in os.listdir(settings.CATALOG_SNAPSHOT_DIR) if name.startswith(snapshots.QUEUE_FILE)])
+
+    def test_builds_wait_for_the_lock(self):
+        results = []
+        build = threading.Thread(target=lambda: results.extend(run_in_threads(snapshots.build, [()])))
+        with snapshots.lock():
+            build.start()
+            build.join(0.3)
+            # the lock is held, as by a build in another process
+            self.assertTrue(build.is_alive())
+            self.assertIsNone(snapshots.get_current_version())
+        build.join()
+        self.assertEqual(snapshots.get_current_version(), results[0]['version'])
+
+
+class SuggestIndexTests(TransactionTestCase):
+
+    def setUp(self):
+        Item.objects.create(name='Red Running Shoe', price=10, cost_price=5, product_type='Mobile', description='d')
+        self.addCleanup(setattr, suggest, '_index', suggest._index)
+
+    def wait_for_rebuild(self):
+        with suggest._lock:
+            pass
+
+    def test_requests_answer_from_the_previous_index_while_it_rebuilds(self):
+        self.assertTrue(suggest.start_rebuild())
+        self.wait_for_rebuild()
+        self.assertEqual([entry['name'] for entry in suggest.suggest('shoe')], ['Red Running Shoe'])
+
+        Item.objects.create(name='Blue Running Shoe', price=10, cost_price=5, product_type='Mobile', description='d')
+        with mock.patch.object(suggest, 'SuggestIndex', wraps=suggest.SuggestIndex) as build:
+            with suggest._lock:
+                # a rebuild is running, the request neither waits nor builds
+                self.assertEqual([entry['name'] for entry in suggest.suggest('shoe')], ['Red Running Shoe'])
+                self.assertFalse(build.called)
+            suggest.suggest('shoe')
+            self.wait_for_rebuild()
+            self.assertEqual(build.call_count, 1)
+        self.assertEqual(sorted(entry['name'] for entry in suggest.suggest('shoe')), ['Blue Running Shoe', 'Red Running Shoe'])
+
+
+class FuzzyIndexTests(TransactionTestCase):
+
+    def setUp(self):
+        create_item('Galaxy Phone')
+        self.addCleanup(setattr, fuzzy, '_index', fuzzy._index)
+        fuzzy._index = None
+
+    def wait_for_rebuild(self):
+        with fuzzy._lock:
+            pass
+
+    def test_requests_answer_from_the_previous_index_while_it_rebuilds(self):
+        # nothing to answer from before the first build
+        self.assertEqual(fuzzy.fuzzy_search('galaxi'), [])
+        self.wait_for_rebuild()
+        phone_id = Item.objects.get().id
+        self.assertEqual([item_id for _, item_id in fuzzy.fuzzy_search('galaxi')], [phone_id])
+
+        create_item('Galaxy Tablet')
+        with mock.patch.object(fuzzy, 'TrigramIndex', wraps=fuzzy.TrigramIndex) as build:
+            with fuzzy._lock:
+                # a rebuild is running, the request neither waits nor builds
+                self.assertEqual([item_id for _, item_id in fuzzy.fuzzy_search('galaxi')], [phone_id])
+                self.assertFalse(build.called)
+            fuzzy.fuzzy_search('galaxi')
+            self.wait_for_rebuild()
+            self.assertEqual(build.call_count, 1)
+        self.assertEqual(len(fuzzy.fuzzy_search('galaxi')), 2)
+
+
+class NavigationTests(TestCase):
+
+    def test_subcategories_reference_their_category_by_id(self):
+        category = ItemCategory.objects.create(name='Phones', category_type='Mobile', slug='phones')
+        ItemSubCategory.objects.create(category=category, name='Android', slug='android')
+        caching.bump_version(NAVIGATION)
+        client = APIClient()
+        for url in ('/categories/', '/category/phones/'):
+            subcategories = client.get(url).json()['subcategories']
+            self.assertEqual([(entry['category'], entry['slug']) for entry in subcategories], [(category.id, 'android')], url)
+
+    def test_category_changes_invalidate_the_cached_menu(self):
+        client = APIClient()
+        ItemCategory.objects.create(name='Phones', category_type='Mobile', slug='phones')
+        caching.bump_version(NAVIGATION)
+        self.assertEqual([entry['slug'] for entry in client.get('/categories/').json()['categories']], ['phones'])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_navigation()['categories'][0]['slug'], 'phones')
+        with self.captureOnCommitCallbacks(execute=True):
+            ItemCategory.objects.create(name='Tablets', category_type='Mobile', slug='tablets')
+        self.assertEqual([entry['slug'] for entry in client.get('/categories/').json()['categories']], ['phones', 'tablets'])
+
+    def test_product_type_pages_name_the_last_category_of_the_tree(self):
+        ItemCategory.objects.create(name='Phones', category_type='Mobile', slug='phones')
+        tablets = ItemCategory.objects.create(name='Tablets', category_type='Mobile', slug='tablets')
+        ItemSubCategory.objects.create(category=tablets, name='Android', slug='android')
+        caching.bump_version(NAVIGATION)
+        response = APIClient().get('/product-type/Mobile/').json()
+        self.assertEqual(response['category'], response['categories'][-1])
+        self.assertEqual([entry['slug'] for entry in response['category']['subcategories']], ['android'])
+
+
+class PopularityTests(TestCase):
+
+    def test_first_sales_recorded_concurrently_are_both_counted(self):
+        item = Item.objects.create(name='Hot Item', price=10, cost_price=5, product_type='Mobile', description='d')
+        when = timezone.now()
+
+        def concurrent_first_sale(*args, **kwargs):
+            # another checkout inserts the row after this one found none
+            ItemPopularity.objects.create(item=item, score=popularity.log2_weight(1, when))
+
+        with mock.patch.object(ItemPopularity.objects, 'bulk_update', side_effect=concurrent_first_sale):
+            popularity.record_sales([(item.id, 1)], when)
+        self.assertAlmostEqual(ItemPopularity.objects.get(item=item).score, popularity.log2_weight(2, when))
+
+    def test_recent_sales_outrank_older_larger_ones(self):
+        user = User.objects.create(username='shopper', email='shopper@example.com')
+        old, recent = create_item('Old Seller'), create_item('New Seller')
+        create_placed_order(user, [old], timezone.now() - timedelta(days=30), quantity=3)
+        create_placed_order(user, [recent], quantity=1)
+        self.assertEqual(popularity.rollup(), 2)
+        self.assertEqual(popularity.get_popular_items(2), [recent, old])
+
+    def test_recorded_orders_add_up_to_the_rollup(self):
+        user = User.objects.create(username='shopper', email='shopper@example.com')
+        items = [create_item(f'Seller {i}') for i in range(3)]
+        for days, bought in ((9, items), (2, items[:2]), (0, items[:1])):
+            order = create_placed_order(user, bought, timezone.now() - timedelta(days=days), quantity=2)
+            popularity.record_order(order)
+        recorded = dict(ItemPopularity.objects.values_list('item_id', 'score'))
+        popularity.rollup()
+        for item_id, score in ItemPopularity.objects.values_list('item_id', 'score'):
+            self.assertAlmostEqual(recorded[item_id], score)
+
+
+class CooccurrenceTests(TransactionTestCase):
+
+    def setUp(self):
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        self.enterContext(override_settings(COOCCURRENCE_STATE_DIR=state_dir.name))
+        self.user = User.objects.create(username='basket', email='basket@example.com')
+        self.items = [
+            Item.objects.create(name=f'Pair {i}', price=10, cost_price=5, product_type='Mobile', description='d')
+            for i in range(4)
+        ]
+
+    def related(self, item):
+        return list(ItemCooccurrence.objects.filter(item=item).order_by('rank').values_list('related_item_id', 'count'))
+
+    def test_orders_committed_late_are_counted(self):
+        a, b, c, _ = self.items
+        create_placed_order(self.user, [a, b])
+        cooccurrence.update()
+        # placed before the last run's watermark but committed after it
+        create_placed_order(self.user, [a, c], timezone.now() - timedelta(minutes=5))
+        self.assertEqual(cooccurrence.update(), (1, 3))
+        self.assertEqual(sorted(self.related(a)), [(b.id, 1), (c.id, 1)])
+        # the orders within the overlap are not counted twice
+        self.assertEqual(cooccurrence.update(), (0, 0))
+        self.assertEqual(sorted(self.related(a)), [(b.id, 1), (c.id, 1)])
+
+    def test_lift_of_every_pair_follows_the_basket_count(self):
+        a, b, c, d = self.items
+        create_placed_order(self.user, [a, b])
+        create_placed_order(self.user, [a, b, c])
+        cooccurrence.update(metric='lift')
+        create_placed_order(self.user, [d])
+        cooccurrence.update(metric='lift')
+        incremental = sorted(ItemCooccurrence.objects.values_list('item_id', 'related_item_id', 'score'))
+        cooccurrence.update(full=True, metric='lift')
+        self.assertEqual(incremental, sorted(ItemCooccurrence.objects.values_list('item_id', 'related_item_id', 'score')))
+
+    def test_items_gone_since_the_last_run_are_left_out(self):
+        a, b, c, d = self.items
+        create_placed_order(self.user, [a, b, c, d])
+        cooccurrence.update()
+        c.delete()
+        Item.objects.filter(pk=d.pk).update(is_active=False)
+        # the stored counts still hold c and d
+        create_placed_order(self.user, [a, b])
+        self.assertEqual(cooccurrence.update(), (1, 2))
+        self.assertEqual(self.related(a), [(b.id, 2)])
+        self.assertEqual(self.related(b), [(a.id, 2)])
+
+
+class FailingEmailBackend(EmailBackend):
+
+    def send_messages(self, messages):
+        raise ConnectionRefusedError('SMTP server is down')
+
+
+class EmailOutboxTests(TestCase):
+
+    @override_settings(CART_STORE='database')
+    def test_checkout_queues_mail_instead_of_sending(self):
+        user = User.objects.create(username='buyer', email='buyer@example.com')
+        address = Address.objects.create(user=user, full_name='f', phone_number='1', street_address='s', apartment_address='a')
+        item = Item.objects.create(name='Shoe', price=100, cost_price=60, stock_count=5, product_type='Mobile', description='d')
+        sync_cart(user, [{'item': item.slug, 'quantity': 1}])
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post('/checkout/', {'address': {'id': address.id}}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(EmailOutbox.objects.filter(status=PENDING).count(), 2)
+
+        self.assertEqual(send_queued(), (2, 0))
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), sorted([settings.EMAIL_HOST_USER, 'buyer@example.com']))
+        self.assertFalse(EmailOutbox.objects.exclude(status=SENT).exists())
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_USE_TLS=False)
+    def test_batch_uses_one_smtp_session(self):
+        for i in range(5):
+            queue_mail(f'Mail {i}', 'Body', 'shop@example.com', ['buyer@example.com'])
+        with mock.patch('smtplib.SMTP') as smtp:
+            self.assertEqual(send_queued(batch_size=10), (5, 0))
+        self.assertEqual(smtp.call_count, 1)
+        self.assertEqual(smtp.return_value.sendmail.call_count, 5)
+        self.assertEqual(send_queued(), (0, 0))
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_USE_TLS=False)
+    def test_session_is_reopened_after_a_failed_send(self):
+        for i in range(3):
+            queue_mail(f'Mail {i}', 'Body', 'shop@example.com', ['buyer@example.com'])
+        with mock.patch('smtplib.SMTP') as smtp:
+            smtp.return_value.sendmail.side_effect = [smtplib.SMTPServerDisconnected('gone'), {}, {}]
+            self.assertEqual(send_queued(batch_size=10), (2, 1))
+        self.assertEqual(smtp.call_count, 2)
+
+    @override_settings(EMAIL_BACKEND='main.tests.FailingEmailBackend', EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_failed_mail_is_retried_with_backoff(self):
+        queued = queue_mail('Subject', 'Body', 'shop@example.com', ['buyer@example.com'])
+        self.assertEqual(send_queued(), (0, 1))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (PENDING, 1))
+        self.assertGreater(queued.next_attempt_at, timezone.now())
+        self.assertIn('SMTP server is down', queued.last_error)
+
+        # not due yet
+        self.assertEqual(send_queued(), (0, 0))
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued(), (0, 1))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (FAILED, 2))
@@ -13,6 +13,7 @@ urlpatterns = [
     path('add-single-item-to-cart/<slug>/', add_single_item_to_cart, name='add-single-item-to-cart'),
     path('remove-item-from-cart/<slug>/', remove_single_item_from_cart, name='remove-single-item-from-cart'),
     path('remove-from-cart/<slug>/', remove_from_cart, name='remove-from-cart'),
+    path('cart-sync/', CartSyncView.as_view(), name='cart-sync'),
     path('cancel-order/<ref_code>/', cancel_order, name='cancel-order'),
     path('wishlist/', WishlistView.as_view(), name='wishlist'),
     path('add-to-wishlist/<slug>/', add_to_wishlist, name='add-to-wishlist'),
@@ -22,6 +23,7 @@ urlpatterns = [
     path('product/<slug>/review/', product_review, name='product-review'),
     
     path('search/', SearchView.as_view(), name='search'),
+    path('suggest/', SuggestView.as_view(), name='suggest'),
     path('about/', AboutView.as_view(), name='about'),
     path('contact/', ContactView.as_view(), name='contact'),
     path('contact-form/', contact_form, name='contact-form'),
@@ -1,30 +1,41 @@
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.conf import settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import NotFound
 from ratelimit.decorators import ratelimit
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db import transaction
 from django.db.models import Q
 from .serializers import *
 from .models import *
-from django.http import HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 import json
-from django.core.mail import send_mail, BadHeaderError
+from django.core.mail import BadHeaderError
 from ecommerce_backend.settings import EMAIL_HOST_USER
 from django.core import serializers
 from django.contrib.auth.models import User
 from time import time
-from django.db.models import Max, Min, Count, Case, When
 from django.views.decorators.csrf import csrf_exempt
-
-import pandas as pd
-from sklearn.metrics.pairwise import linear_kernel
-from sklearn.feature_extraction.text import TfidfVectorizer
+from .recommendations import get_similar_item_ids
+from .popularity import get_popular_items, record_order
+from .paginations import KeysetPagination, SearchPagination
+from .navigation import get_category_tree, get_navigation
+from .search import filter_matching, search_items
+from .conditional import catalog_validators
+from .response_cache import cache_response, private_response
+from .fuzzy import fuzzy_search
+from .suggest import suggest
+from .facets import count_facets, filter_items, get_facet_summary
+from .cart import CartError, get_cart_store, sync_cart
+from .mail import queue_mail
 
 
 PRODUCT_TYPES = (
@@ -34,29 +45,37 @@ PRODUCT_TYPES = (
 )
 
 
-def get_recommendation_by_title(title, items):
-    dataset = pd.DataFrame(items.values())
-    tfidf = TfidfVectorizer(stop_words='english')
-    dataset['description'] = dataset['description'].fillna('')
-    tfidf_matrix = tfidf.fit_transform(dataset['description'])
-    cosine_sim = linear_kernel(tfidf_matrix, tfidf_matrix)
-    indices = pd.Series(dataset.index, index=dataset['name']).drop_duplicates()
-    idx = indices[title]
-    sim_scores = list(enumerate(cosine_sim[idx]))
-    sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True)
-    sim_scores = sim_scores[1:11]
-    item_indices = [i[0] for i in sim_scores]
-    return dataset['id'].iloc[item_indices]
-
-def get_popular_items():
-    order_items = OrderItem.objects.filter(ordered=True).values('item').annotate(count=Count('pk', distinct=True)).order_by('-count')
-    order_items_ids = [item['item'] for item in order_items]
-    preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(order_items_ids)])
-    popular_items = Item.objects.filter(pk__in=order_items_ids).order_by(preserved)
-    if popular_items.count() < 8:
-        rem_items = Item.objects.exclude(pk__in=order_items_ids)[:8-popular_items.count()]
-        popular_items = popular_items | rem_items
-    return popular_items
+def get_related_products(item):
+    similarities = ItemSimilarity.objects.filter(item=item, similar_item__is_active=True).select_related('similar_item').order_by('rank')
+    related_products = [similarity.similar_item for similarity in similarities]
+    if not related_products:
+        # item not in the precomputed table yet, answer from the stored model
+        related_products_id = get_similar_item_ids(item.id)
+        related_items = Item.objects.in_bulk(related_products_id)
+        related_products = [related_items[pk] for pk in related_products_id if pk in related_items]
+    return related_products
+
+
+def get_bought_together(item, count=4):
+    cooccurrences = ItemCooccurrence.objects.filter(item=item, related_item__is_active=True).select_related('related_item').order_by('rank')[:count]
+    return [cooccurrence.related_item for cooccurrence in cooccurrences]
+
+
+def get_item_detail(item, item_context):
+    reviews = Review.objects.filter(item=item)
+    related_products = get_related_products(item)
+    bought_together = get_bought_together(item)
+
+    item_serializer = ItemSerializer(item, context=item_context).data
+    related_products_serializer = ItemSerializer(related_products, many=True, context=item_context).data
+    bought_together_serializer = ItemSerializer(bought_together, many=True, context=item_context).data
+    reviews_serializer = ReviewSerializer(reviews, many=True).data
+    return {
+        'item':  item_serializer,
+        'related_products':  related_products_serializer,
+        'bought_together': bought_together_serializer,
+        'reviews': reviews_serializer,
+    }
 
 
 def create_ref_code():
@@ -69,81 +88,104 @@ class CheckoutView(APIView):
     @method_decorator(ratelimit(method='POST', key='ip', rate='10/s', block=True))
     def post(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            total_price = float(order.get_total())
-            if total_price > 0:
-                address = self.request.data['address']
-                try:
-                    save_order_db(order, total_price, address)
-                except Exception as e:
-                    return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-
-                # send email
-                products = []
-                for item in order.items.all():
-                    products.append(item)
-                my_items = ''.join(str(v) + ',\n' for v in products)
-                subject = "Order Confirmation - The Fashion Fit"
-                message = "Name: " + str(self.request.user) + "\nItems:\n" + my_items + "\nTotal Price: Rs." + str(total_price)
-                message2 = "Your order of items:\n" + my_items + "\nTotal Price: Rs." + str(total_price) + "\nYou can contact us on sales@thefashionfit.com"
-                try:
-                    send_mail(subject, message, EMAIL_HOST_USER, [EMAIL_HOST_USER], fail_silently=False)
-                except BadHeaderError:
-                    return Response({"message": "Invalid header found."}, status=status.HTTP_400_BAD_REQUEST)
-                except Exception as e:
-                    print(e)
-                try:
-                    send_mail(subject, message2, EMAIL_HOST_USER, [
-                                self.request.user.email], fail_silently=False)
-                except BadHeaderError:
-                    return Response({"message": "Invalid header found."}, status=status.HTTP_400_BAD_REQUEST)
-                except Exception as e:
-                    print(e)
-
-                return Response({"message": "Your order was successful!"}, status=status.HTTP_200_OK)
-            else:
-                return Response({"message": "Error while validating form data. Please try again..."}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                with transaction.atomic():
+                    order, total_price = place_order(self.request.user, self.request.data['address'])
+                    queue_order_confirmation(order, self.request.user, total_price)
+            except (ObjectDoesNotExist, CartError):
+                raise
+            except Exception as e:
+                return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            return Response({"message": "Your order was successful!"}, status=status.HTTP_200_OK)
+        except CartError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except ObjectDoesNotExist:
             return Response({"message": "You do not have an active order"}, status=status.HTTP_400_BAD_REQUEST)
         except:
             return Response({"message": "Internal server error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def queue_order_confirmation(order, user, total_price):
+    my_items = ''.join(str(v) + ',\n' for v in order.items.select_related('item', 'color'))
+    subject = "Order Confirmation - The Fashion Fit"
+    message = "Name: " + str(user) + "\nItems:\n" + my_items + "\nTotal Price: Rs." + str(total_price)
+    message2 = "Your order of items:\n" + my_items + "\nTotal Price: Rs." + str(total_price) + "\nYou can contact us on sales@thefashionfit.com"
+    queue_mail(subject, message, EMAIL_HOST_USER, [EMAIL_HOST_USER])
+    queue_mail(subject, message2, EMAIL_HOST_USER, [user.email])
+
+
+def place_order(user, address):
+    '''The cart of `user` becomes an order and is marked ordered in one transaction.'''
+    with transaction.atomic():
+        order = get_cart_store().checkout(user)
+        total_price = float(order.get_total())
+        if total_price <= 0:
+            raise CartError("Error while validating form data. Please try again...")
+        save_order_db(order, total_price, address)
+    return order, total_price
+
+
 def save_order_db(order, total_price, address):
-    order.ordered_date = timezone.now()
-    order.total_price = total_price
-    order.shipping_address = Address.objects.filter(id=address['id']).first()
-    order.payment = PaymentMethod.objects.filter(payment_code="COD").first()
-    order.save()
-
-    order_items = order.items.all()
-    order_items.update(ordered=True)
-    total_profit_loss = 0
-    for item in order_items:
-        # item.ordered_date = timezone_now
-        total_profit_loss += item.profit_loss
-        item.save()
-
-    order.ordered = True
-    order.status = 0
-    order.ref_code = create_ref_code()
-    order.total_profit_loss = total_profit_loss
-    order.save()
+    '''
+    Marks the order and its lines ordered in one transaction, with the same
+    number of queries whatever the size of the cart: the lines are loaded with
+    their items at once, priced in memory and written back with one bulk update.
+    '''
+    with transaction.atomic():
+        now = timezone.now()
+        lines = list(order.items.select_related('item'))
+        for line in lines:
+            line.compute_prices()
+            line.ordered = True
+            line.ordered_date = now
+        OrderItem.objects.bulk_update(lines, ['ordered', 'ordered_date', 'selling_price', 'profit_loss'])
+
+        order.ordered_date = now
+        order.total_price = total_price
+        order.shipping_address = Address.objects.filter(id=address['id']).first()
+        order.payment = PaymentMethod.objects.filter(payment_code="COD").first()
+        order.ordered = True
+        order.status = 0
+        order.ref_code = create_ref_code()
+        order.total_profit_loss = sum(line.profit_loss for line in lines)
+        order.save(update_fields=[
+            'ordered_date', 'total_price', 'shipping_address', 'payment', 'ordered', 'status', 'ref_code', 'total_profit_loss',
+        ])
+        record_order(order, lines)
+
+
+def serialize_item_list(items, request, context):
+    '''
+    Product grids render the slim item card. A comma separated ?fields= renders
+    ItemSerializer restricted to those fields instead.
+    '''
+    fields = request.query_params.get('fields')
+    if fields:
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        return ItemSerializer(items, many=True, context=context, fields=fields).data
+    return ItemCardSerializer(items, many=True, context=context).data
 
 
 class HomeView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
+    @method_decorator(private_response)
+    @method_decorator(condition(*catalog_validators(personal=True, refresh_every=settings.POPULAR_ITEMS_MAX_AGE)))
+    @method_decorator(cache_response(refresh_every=settings.POPULAR_ITEMS_MAX_AGE))
     def get(self, *args, **kwargs):
-        items = Item.objects.filter(is_active=True).order_by('-id')
+        paginator = KeysetPagination(self.request.query_params.get('sort'))
+        items = paginator.paginate_queryset(Item.objects.filter(is_active=True), self.request)
         popular_items = get_popular_items()
         posts = Post.objects.filter(status=1).order_by('-created_on')[:3]
 
-        items_serializer = ItemSerializer(items, many=True, context={'user_id': self.request.user.id}).data
-        popular_items_serializer = ItemSerializer(popular_items, many=True, context={'user_id': self.request.user.id}).data
+        item_context = {'user_id': self.request.user.id}
+        items_serializer = serialize_item_list(items, self.request, item_context)
+        popular_items_serializer = serialize_item_list(popular_items, self.request, item_context)
         posts_serializer = PostSerializer(posts, many=True).data
         context = {
             'all_items':  items_serializer,
+            'next_cursor': paginator.next_cursor,
             'all_popular_items':  popular_items_serializer,
             'blogs':  posts_serializer,
         }
@@ -157,18 +199,26 @@ class OrderSummaryView(APIView):
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.filter(user=self.request.user, ordered=False).first()
-            context = {
-                'order': OrderSerializer(order).data,
-                'subtotal': order.get_subtotal() if order else 0,
-                'total': order.get_total() if order else 0,
-            }
-            return Response(context, status=status.HTTP_200_OK)
+            return Response(get_cart_store().get_context(self.request.user), status=status.HTTP_200_OK)
         except Exception as e:
             print(e)
             return Response({"message": "Something went wrong."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class CartSyncView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @method_decorator(ratelimit(method='POST', key='ip', rate='10/s', block=True))
+    def post(self, *args, **kwargs):
+        data = self.request.data
+        try:
+            # a body that is not an object has no operations, sync_cart rejects them
+            sync_cart(self.request.user, data.get('operations') if isinstance(data, dict) else None)
+        except CartError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_cart_store().get_context(self.request.user), status=status.HTTP_200_OK)
+
+
 class WishlistView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     
@@ -187,21 +237,11 @@ class WishlistView(APIView):
 class ItemDetailView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
+    @method_decorator(private_response)
+    @method_decorator(cache_response())
     def get(self, *args, **kwargs):
-        item = Item.objects.get(slug=self.kwargs['slug'])
-        items = Item.objects.filter(is_active=True).order_by('-id')
-        reviews = Review.objects.filter(item=item)
-        related_products_id = get_recommendation_by_title(item.name, items)
-        related_products = Item.objects.filter(pk__in=related_products_id)
-
-        item_serializer = ItemSerializer(item, context={'user_id': self.request.user.id}).data
-        related_products_serializer = ItemSerializer(related_products, many=True, context={'user_id': self.request.user.id}).data
-        reviews_serializer = ReviewSerializer(reviews, many=True).data
-        context = {
-            'item':  item_serializer,
-            'related_products':  related_products_serializer,
-            'reviews': reviews_serializer,
-        }
+        item = ItemSerializer.setup_eager_loading(Item.objects.all()).get(slug=self.kwargs['slug'])
+        context = get_item_detail(item, {'user_id': self.request.user.id})
 
         return Response(context, status=status.HTTP_200_OK)
 
@@ -209,30 +249,25 @@ class ItemDetailView(APIView):
 class ShopDetailView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
+    @method_decorator(private_response)
+    @method_decorator(condition(*catalog_validators(personal=True)))
+    @method_decorator(cache_response())
     def get(self, *args, **kwargs):
-        all_items = Item.objects.filter(is_active=True).order_by('-id')
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-        price_range_min = Item.objects.all().aggregate(Min('price'))
-        price_range_max = Item.objects.all().aggregate(Max('price'))
-        price_range = {'min': price_range_min, 'max': price_range_max}
-        brands = Brand.objects.all().distinct('name')
-        colors = Color.objects.all().distinct('color_code')
+        paginator = KeysetPagination(self.request.query_params.get('sort'))
+        all_items = paginator.paginate_queryset(Item.objects.filter(is_active=True), self.request)
+        navigation = get_navigation()
+        facets = get_facet_summary()
 
-        all_items_serializer = ItemSerializer(all_items, many=True, context={'user_id': self.request.user.id}).data
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        for category in categories_serializer:
-            category['subcategories'] = ItemSubCategorySerializer(ItemSubCategory.objects.filter(category_id=category['id']), many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
-        brands_serializer = BrandSerializer(brands, many=True).data
-        colors_serializer = ColorSerializer(colors, many=True).data
+        all_items_serializer = serialize_item_list(all_items, self.request, {'user_id': self.request.user.id})
+        categories = get_category_tree()
         context = {
             'items':  all_items_serializer,
-            'categories':  categories_serializer,
-            'subcategories':  subcategories_serializer,
-            'price_range': price_range,
-            'brands': brands_serializer,
-            'colors': colors_serializer
+            'next_cursor': paginator.next_cursor,
+            'categories': categories,
+            'subcategories': navigation['subcategories'],
+            'price_range': facets['price_range'],
+            'brands': facets['brands'],
+            'colors': facets['colors']
         }
         return Response(context, status=status.HTTP_200_OK)
 
@@ -240,28 +275,27 @@ class ShopDetailView(APIView):
 class CategoryDetailView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
+    @method_decorator(private_response)
+    @method_decorator(cache_response())
     def get(self, *args, **kwargs):
         # raise 404 error if category is not found, replace try-except block
         category = get_object_or_404(ItemCategory, slug=self.kwargs['slug'])
 
-        all_items = Item.objects.filter(is_active=True, category=category).order_by('-id')
+        paginator = KeysetPagination(self.request.query_params.get('sort'))
+        all_items = paginator.paginate_queryset(Item.objects.filter(is_active=True, category=category), self.request)
         subcategories = ItemSubCategory.objects.filter(is_active=True, category=category)
-        price_range_min = Item.objects.all().aggregate(Min('price'))
-        price_range_max = Item.objects.all().aggregate(Max('price'))
-        price_range = {'min': price_range_min, 'max': price_range_max}
-        brands = Brand.objects.all().distinct('name')
-        colors = Color.objects.all().distinct('color_code')
+        facets = get_facet_summary(Item.objects.filter(is_active=True, category=category), scope=f'category:{category.pk}')
 
         all_items_serializer = ItemSerializer(all_items, many=True, context={'user_id': self.request.user.id}).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
-        brands_serializer = BrandSerializer(brands, many=True).data
-        colors_serializer = ColorSerializer(colors, many=True).data
+        # the category is in the response once, the subcategories only hold its id
+        subcategories_serializer = CategoryTreeSubCategorySerializer(subcategories, many=True).data
         context = {
             'items': all_items_serializer,
+            'next_cursor': paginator.next_cursor,
             'subcategories': subcategories_serializer,
-            'price_range': price_range,
-            'brands': brands_serializer,
-            'colors': colors_serializer,
+            'price_range': facets['price_range'],
+            'brands': facets['brands'],
+            'colors': facets['colors'],
             'category': ItemCategorySerializer(category).data,
         }
 
@@ -273,28 +307,18 @@ class SubcategoryDetailView(APIView):
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
         all_items = Item.objects.filter(is_active=True).order_by('-id')
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-        price_range_min = Item.objects.all().aggregate(Min('price'))
-        price_range_max = Item.objects.all().aggregate(Max('price'))
-        price_range = {'min': price_range_min, 'max': price_range_max}
-        brands = Brand.objects.all().distinct('name')
-        colors = Color.objects.all().distinct('color_code')
+        navigation = get_navigation()
+        facets = get_facet_summary()
 
         all_items_serializer = ItemSerializer(all_items, many=True, context={'user_id': self.request.user.id}).data
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        for category in categories_serializer:
-            category['subcategories'] = ItemSubCategorySerializer(ItemSubCategory.objects.filter(category_id=category['id']), many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
-        brands_serializer = BrandSerializer(brands, many=True).data
-        colors_serializer = ColorSerializer(colors, many=True).data
+        categories = get_category_tree()
         context = {
             'all_items':  all_items_serializer,
-            'categories':  categories_serializer,
-            'subcategories':  subcategories_serializer,
-            'price_range': price_range,
-            'brands': brands_serializer,
-            'colors': colors_serializer
+            'categories': categories,
+            'subcategories': navigation['subcategories'],
+            'price_range': facets['price_range'],
+            'brands': facets['brands'],
+            'colors': facets['colors']
         }
 
         # check if slug1 is in fact a category, else raise 404 error
@@ -315,48 +339,64 @@ class SearchView(APIView):
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def post(self, *args, **kwargs):
         search = self.request.data['search_q']
-        results = Item.objects.filter(Q(name__icontains=search), is_active=True)
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
+        sort = self.request.query_params.get('sort')
+        if sort in KeysetPagination.orderings:
+            paginator = KeysetPagination(sort)
+            results = paginator.paginate_queryset(filter_matching(Item.objects.filter(is_active=True), search), self.request)
+        else:
+            # best matches first
+            paginator = SearchPagination('relevance')
+            hits = paginator.paginate_hits(lambda limit, after: search_items(search, limit, after), self.request)
+            found = Item.objects.in_bulk([item_id for _, item_id in hits])
+            results = [found[item_id] for _, item_id in hits if item_id in found]
+
+        # nothing matched the words as typed, show the closest names instead of an empty page
+        scores = None
+        if not results and not paginator.get_param(self.request, paginator.cursor_query_param):
+            hits = fuzzy_search(search, paginator.get_page_size(self.request))
+            found = Item.objects.in_bulk([item_id for _, item_id in hits])
+            results = [found[item_id] for _, item_id in hits if item_id in found]
+            scores = [round(score, 3) for score, item_id in hits if item_id in found]
+        navigation = get_navigation()
         query = search
-        price_range_min = Item.objects.all().aggregate(Min('price'))
-        price_range_max = Item.objects.all().aggregate(Max('price'))
-        price_range = {'min': price_range_min, 'max': price_range_max}
-        brands = Brand.objects.all().distinct('name')
-        colors = Color.objects.all().distinct('color_code')
-
-        results_serializer = ItemSerializer(results, many=True, context={'user_id': self.request.user.id}).data
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        for category in categories_serializer:
-            category['subcategories'] = ItemSubCategorySerializer(ItemSubCategory.objects.filter(category_id=category['id']), many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
-        brands_serializer = BrandSerializer(brands, many=True).data
-        colors_serializer = ColorSerializer(colors, many=True).data
+        facets = get_facet_summary()
+
+        results_serializer = serialize_item_list(results, self.request, {'user_id': self.request.user.id})
+        categories = get_category_tree()
         context = {
             'query': query,
             'items': results_serializer,
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
-            'price_range': price_range,
-            'brands': brands_serializer,
-            'colors': colors_serializer
+            'next_cursor': paginator.next_cursor,
+            'fuzzy_scores': scores,
+            'categories': categories,
+            'subcategories': navigation['subcategories'],
+            'price_range': facets['price_range'],
+            'brands': facets['brands'],
+            'colors': facets['colors']
         }
         
         return Response(context, status=status.HTTP_200_OK)
 
 
+class SuggestView(APIView):
+
+    @method_decorator(ratelimit(method='GET', key='ip', rate='20/s', block=True))
+    def get(self, *args, **kwargs):
+        # answered from the in-process prefix index, no database query
+        context = {
+            'suggestions': suggest(self.request.query_params.get('q', '')),
+        }
+        return Response(context, status=status.HTTP_200_OK)
+
+
 class AboutView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -366,14 +406,10 @@ class ContactView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -383,14 +419,10 @@ class PrivacyPolicyView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -400,14 +432,10 @@ class TermsConditionsView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -417,14 +445,10 @@ class FAQView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -435,28 +459,15 @@ class FAQView(APIView):
 @permission_classes([permissions.IsAuthenticated])
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item,
-        user=request.user,
-        ordered=False,
-        ordered_date=timezone.now()
-    )
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            return Response({"message": "This item quantity was updated."}, status=status.HTTP_200_OK)
-        else:
-            order.items.add(order_item)
-            return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
-    else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
-        return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
+    store = get_cart_store()
+    in_cart = (item.id, None) in store.get_quantities(request.user)
+    try:
+        store.apply(request.user, [{'item': slug, 'add': 1}])
+    except CartError as e:
+        return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if in_cart:
+        return Response({"message": "This item quantity was updated."}, status=status.HTTP_200_OK)
+    return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
@@ -469,34 +480,15 @@ def add_items_to_cart(request, slug):
         color = request.data['color']
         if int(quantity) > 0:
             if int(quantity) <= item.stock_count:
-                order_item, created = OrderItem.objects.get_or_create(
-                    item=item,
-                    color = Color.objects.get(id=color),
-                    user=request.user,
-                    ordered=False
-                )
-                order_qs = Order.objects.filter(user=request.user, ordered=False)
-                if order_qs.exists():
-                    order = order_qs[0]
-                    # check if the order item is in the order
-                    if order.items.filter(item__slug=item.slug, color=Color.objects.get(id=color)).exists():
-                        order_item.quantity = order_item.quantity + int(quantity)
-                        order_item.save()
-                        return Response({"message": "This order item was updated."}, status=status.HTTP_200_OK)
-                    else:
-                        order_item.quantity = int(quantity)
-                        order_item.color = Color.objects.get(id=color)
-                        order_item.save()
-                        order.items.add(order_item)
-                        return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
-                else:
-                    ordered_date = timezone.now()
-                    order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-                    order_item.quantity = int(quantity)
-                    order_item.color = Color.objects.get(id=color)
-                    order_item.save()
-                    order.items.add(order_item)
-                    return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
+                store = get_cart_store()
+                in_cart = (item.id, int(color)) in store.get_quantities(request.user)
+                try:
+                    store.apply(request.user, [{'item': slug, 'color': color, 'add': int(quantity)}])
+                except CartError as e:
+                    return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                if in_cart:
+                    return Response({"message": "This order item was updated."}, status=status.HTTP_200_OK)
+                return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
             else:
                 return Response({"message": "The quantity cannot be more than "+str(item.stock_count)}, status=status.HTTP_400_BAD_REQUEST)
         else:
@@ -511,36 +503,21 @@ def add_items_to_cart(request, slug):
 @permission_classes([permissions.IsAuthenticated])
 def add_single_item_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item,
-        user=request.user,
-        ordered=False
-    )
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-
-            my_items = OrderItem.objects.filter(user=request.user, ordered=False)
-            data = serializers.serialize('json', my_items)
-            order_items = json.loads(data)
-            my_order = Order.objects.filter(user=request.user, ordered=False)
-            data2 = serializers.serialize('json', my_order)
-            my_order = json.loads(data2)
-            # messages.success(request, "This item quantity was updated.")
-            # return redirect("order-cart")
-            return Response({'success': 'Success', 'order_items': order_items, 'my_order': my_order}, status=status.HTTP_200_OK)
-        else:
-            order.items.add(order_item)
-            return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
-    else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
-        return Response({"message": "This item was added to your cart."}, status=status.HTTP_400_BAD_REQUEST)
+    store = get_cart_store()
+    in_cart = (item.id, None) in store.get_quantities(request.user)
+    try:
+        store.apply(request.user, [{'item': slug, 'add': 1}])
+    except CartError as e:
+        return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if in_cart:
+        context = store.get_context(request.user)
+        return Response({'success': 'Success', 'order_items': context['order']['items'], 'my_order': context['order']}, status=status.HTTP_200_OK)
+    return Response({"message": "This item was added to your cart."}, status=status.HTTP_200_OK)
+
+
+def find_cart_line(quantities, item):
+    # these views name the item only, they act on its first line whatever the color
+    return next((key for key in quantities if key[0] == item.id), None)
 
 
 @api_view(['POST'])
@@ -548,30 +525,14 @@ def add_single_item_to_cart(request, slug):
 @permission_classes([permissions.IsAuthenticated])
 def remove_single_item_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
-
-            my_items = OrderItem.objects.filter(
-                user=request.user, ordered=False)
-            data = serializers.serialize('json', my_items)
-            order_items = json.loads(data)
-            return Response({'status': 'Success', 'order_items': order_items}, status=status.HTTP_200_OK)
+    store = get_cart_store()
+    quantities = store.get_quantities(request.user)
+    if quantities:
+        key = find_cart_line(quantities, item)
+        if key is not None:
+            store.apply(request.user, [{'item': slug, 'color': key[1], 'add': -1}])
+            context = store.get_context(request.user)
+            return Response({'status': 'Success', 'order_items': context['order']['items']}, status=status.HTTP_200_OK)
         else:
             return Response({"message": "This item was not in your cart."}, status=status.HTTP_400_BAD_REQUEST)
     else:
@@ -583,22 +544,12 @@ def remove_single_item_from_cart(request, slug):
 @permission_classes([permissions.IsAuthenticated])
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            order.items.remove(order_item)
-            order_item.delete()
-
+    store = get_cart_store()
+    quantities = store.get_quantities(request.user)
+    if quantities:
+        key = find_cart_line(quantities, item)
+        if key is not None:
+            store.apply(request.user, [{'item': slug, 'color': key[1], 'quantity': 0}])
             return Response({"message": "This item was removed from your cart."}, status=status.HTTP_200_OK)
         else:
             return Response({"message": "This item was not in your cart."}, status=status.HTTP_400_BAD_REQUEST)
@@ -669,12 +620,13 @@ def contact_form(request):
             email = request.data['email']
             subject = request.data['subject']
             message = request.data['message']
-            contact_us = Contact.objects.create(name=name, email=email, subject=subject, message=message)
-
-            subject = subject + " - Contact Fashion Fit"
-            message = "Name: " + name + "\nEmail: " + email + "\nMessage: " + message
             try:
-                send_mail(subject, message, email, [EMAIL_HOST_USER], fail_silently=False)
+                with transaction.atomic():
+                    contact_us = Contact.objects.create(name=name, email=email, subject=subject, message=message)
+
+                    subject = subject + " - Contact Fashion Fit"
+                    message = "Name: " + name + "\nEmail: " + email + "\nMessage: " + message
+                    queue_mail(subject, message, email, [EMAIL_HOST_USER])
             except BadHeaderError:
                 return Response({"message": "Invalid header found."}, status=status.HTTP_400_BAD_REQUEST)
             return Response({"message": "Contact form submitted."}, status=status.HTTP_200_OK)
@@ -706,19 +658,16 @@ def product_review(request, slug):
 class BlogsView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
+    @method_decorator(cache_response())
     def get(self, *args, **kwargs):
         posts = Post.objects.filter(status=1).order_by('-created_on')
-
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
+        navigation = get_navigation()
         
         posts_serializer = PostSerializer(posts, many=True).data
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
         context = {
             'blogs': posts_serializer,
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -729,13 +678,12 @@ class BlogView(APIView):
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
         posts = Post.objects.filter(slug=kwargs['slug']).first()
-        categories = ItemCategory.objects.filter(is_active=True)
+        navigation = get_navigation()
         
         posts_serializer = PostSerializer(posts).data
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
         context = {
             'blog': posts_serializer,
-            'categories': categories_serializer,
+            'categories': navigation['categories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -745,14 +693,10 @@ class OrderConfirmation(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-        
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -762,14 +706,10 @@ class ThankYou(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-        
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -780,15 +720,12 @@ class DashboardPage(APIView):
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
     def get(self, *args, **kwargs):
         profile = self.request.user
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
+        navigation = get_navigation()
         
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
         context = {
             'profile': profile,
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -810,30 +747,26 @@ class OrdersViewPage(APIView):
 
 @api_view(['GET'])
 def get_product_type(request, slug):
-    all_items = Item.objects.filter(product_type=slug).order_by('-id')
-    categories = ItemCategory.objects.filter(is_active=True)
-    subcategories = ItemSubCategory.objects.filter(is_active=True)
-    price_range_min = Item.objects.all().aggregate(Min('price'))
-    price_range_max = Item.objects.all().aggregate(Max('price'))
-    price_range = {'min': price_range_min, 'max': price_range_max}
-    brands = Brand.objects.all().distinct('name')
-    colors = Color.objects.all().distinct('color_code')
+    # the slug names a cache scope below, only the known types get one
+    if slug not in dict(Item._meta.get_field('product_type').choices):
+        raise Http404
+    paginator = KeysetPagination(request.query_params.get('sort'))
+    all_items = paginator.paginate_queryset(Item.objects.filter(product_type=slug), request)
+    navigation = get_navigation()
+    facets = get_facet_summary(Item.objects.filter(product_type=slug), scope=f'product_type:{slug}')
 
     all_items_serializer = ItemSerializer(all_items, many=True, context={'user_id': request.user.id}).data
-    categories_serializer = ItemCategorySerializer(categories, many=True).data
-    for category in categories_serializer:
-        category['subcategories'] = ItemSubCategorySerializer(ItemSubCategory.objects.filter(category_id=category['id']), many=True).data
-    subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
-    brands_serializer = BrandSerializer(brands, many=True).data
-    colors_serializer = ColorSerializer(colors, many=True).data
+    categories = get_category_tree()
     context = {
         'items':  all_items_serializer,
-        'categories':  categories_serializer,
-        'subcategories':  subcategories_serializer,
-        'price_range': price_range,
-        'brands': brands_serializer,
-        'colors': colors_serializer,
-        'category': ItemCategorySerializer(category).data,
+        'next_cursor': paginator.next_cursor,
+        'categories': categories,
+        'subcategories': navigation['subcategories'],
+        'price_range': facets['price_range'],
+        'brands': facets['brands'],
+        'colors': facets['colors'],
+        # the last node of the tree, subcategories included
+        'category': categories[-1] if categories else None,
     }
     return Response(context, status=status.HTTP_200_OK)
 
@@ -841,15 +774,12 @@ def get_product_type(request, slug):
 class CategoriesView(APIView):
 
     @method_decorator(ratelimit(method='GET', key='ip', rate='10/s', block=True))
+    @method_decorator(condition(*catalog_validators()))
     def get(self, *args, **kwargs):
-        categories = ItemCategory.objects.filter(is_active=True)
-        subcategories = ItemSubCategory.objects.filter(is_active=True)
-        
-        categories_serializer = ItemCategorySerializer(categories, many=True).data
-        subcategories_serializer = ItemSubCategorySerializer(subcategories, many=True).data
+        navigation = get_navigation()
         context = {
-            'categories': categories_serializer,
-            'subcategories': subcategories_serializer,
+            'categories': navigation['categories'],
+            'subcategories': navigation['subcategories'],
         }
         
         return Response(context, status=status.HTTP_200_OK)
@@ -970,38 +900,28 @@ class FilterProductView(APIView):
         try:
             filters = self.request.data['filters']
 
-            # problem: get only distinct product
-            
             items = Item.objects.filter(is_active=True)
-            if filters['search_query']:
-                items = items.filter(Q(name__icontains=filters['search_query']), is_active=True)
-            if filters['categories']:
-                items = items.filter(category__slug__in=list(set(filters['categories'])))
-            if filters['subcategories']:
-                items = items.filter(subcategory__slug__in=list(set(filters['subcategories'])))
-            if filters['sizes']:
-                items = items.filter(size__size_code__in=list(set(filters['sizes'])))
-            if filters['brands']:
-                items = items.filter(brand__slug__in=list(set(filters['brands'])))
-            if filters['price_range']:
-                items = items.filter(price__range=filters['price_range'])
-            
-            items = items.order_by('-id')
-            if filters['sort']:
-                if filters['sort'] == "price_low":
-                    items = items.order_by('price')
-                elif filters['sort'] == "price_high":
-                    items = items.order_by('-price')
-                else:
-                    pass
+            if filters.get('search_query'):
+                items = filter_matching(items, filters['search_query'])
+            paginator = KeysetPagination(filters.get('sort'))
+            # the counts do not change while paging through the same filters
+            facet_counts = None
+            if not paginator.get_param(self.request, paginator.cursor_query_param):
+                facet_counts = count_facets(items, filters)
+            items = paginator.paginate_queryset(filter_items(items, filters), self.request)
 
             # serializers
-            items_serializers = ItemSerializer(items, many=True, context={'user_id': self.request.user.id}).data
+            items_serializers = serialize_item_list(items, self.request, {'user_id': self.request.user.id})
 
             context = {
                 "items": items_serializers,
+                "next_cursor": paginator.next_cursor,
+                "facets": facet_counts,
             }
             return Response(context, status=status.HTTP_200_OK)
+        except NotFound:
+            # a bad cursor
+            raise
         except Exception as e:
             print(e)
             return Response({"message": "Internal server error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -3,6 +3,8 @@ from rest_framework import serializers
 
 
 class UserSerializer(serializers.ModelSerializer):
+    prefetch_related_fields = ('groups', 'user_permissions')
+
     class Meta:
         model = User
         fields = ['id', 'is_superuser', 'is_superuser', 'username', 'first_name', 'last_name', 'email', 'groups', 'user_permissions']
@@ -1,15 +1,15 @@
-from django.core.mail import send_mail
 from decouple import config
 
+from main.mail import queue_mail
+
 
 class Util:
     @staticmethod
     def send_email_register(data):
 
-        email_response = send_mail(
+        email_response = queue_mail(
             data['email_subject'],
             data['email_body'],
             config('EMAIL_HOST_USER'),
             [data['email_receiver']],
-            fail_silently=False,
         )
\ No newline at end of file
@@ -7,10 +7,11 @@ from django.contrib.auth import login, authenticate
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.contrib.auth.tokens import default_token_generator
-from django.core.mail import BadHeaderError, send_mail
+from django.core.mail import BadHeaderError
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.http import HttpResponse
+from django.db import transaction
 from django.db.models import Q
 from django.contrib.sites.shortcuts import get_current_site
 from django.contrib.auth import get_user_model
@@ -24,6 +25,7 @@ from rest_framework import permissions
 from rest_framework.views import APIView
 from django.utils.decorators import method_decorator
 from .models import *
+from main.mail import queue_mail
 
 
 UserModel = get_user_model()
@@ -45,32 +47,33 @@ def register(request):
         if email_exist:
             return Response({'message': 'Email already exist. Login to continue.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        user = User.objects.create(
-            username=email,
-            email=email,
-            first_name=first_name,
-            last_name=last_name,
-            is_active=False
-        )
-        user.set_password(raw_password)
-        user.save()
-
-        current_site = get_current_site(request)
-        subject = "Verify your email"
-        email_template_name = "users/verify_email.txt"
-        c = {
-            "email": user.email,
-            'domain': current_site,
-            'site_name': 'Interface',
-            "uid": urlsafe_base64_encode(force_bytes(user.pk)),
-            "user": user,
-            'token': default_token_generator.make_token(user),
-            'protocol': 'http',
-        }
-        email = render_to_string(email_template_name, c)
         try:
-            email = send_mail(subject, email, settings.EMAIL_HOST_USER, [
-                                user.email], fail_silently=False)
+            # the account is only created along with its verification mail
+            with transaction.atomic():
+                user = User.objects.create(
+                    username=email,
+                    email=email,
+                    first_name=first_name,
+                    last_name=last_name,
+                    is_active=False
+                )
+                user.set_password(raw_password)
+                user.save()
+
+                current_site = get_current_site(request)
+                subject = "Verify your email"
+                email_template_name = "users/verify_email.txt"
+                c = {
+                    "email": user.email,
+                    'domain': current_site,
+                    'site_name': 'Interface',
+                    "uid": urlsafe_base64_encode(force_bytes(user.pk)),
+                    "user": user,
+                    'token': default_token_generator.make_token(user),
+                    'protocol': 'http',
+                }
+                email = render_to_string(email_template_name, c)
+                queue_mail(subject, email, settings.EMAIL_HOST_USER, [user.email])
         except BadHeaderError:
             return Response({'message': 'Invalid or expired token.'}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -126,8 +129,7 @@ def forgot(request):
                     }
                     email = render_to_string(email_template_name, c)
                     try:
-                        send_mail(subject, email, settings.EMAIL_HOST_USER, [
-                                  user.email], fail_silently=False)
+                        queue_mail(subject, email, settings.EMAIL_HOST_USER, [user.email])
                     except BadHeaderError:
                         return HttpResponse('Invalid header found.')
                     messages.success(request, "Password reset successfully.")